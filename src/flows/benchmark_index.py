@@ -0,0 +1,144 @@
+"""Compare the recall, size and speed of the index types and embedding encodings"""
+
+import argparse
+import os
+import time
+
+import faiss
+import numpy as np
+from dotenv import load_dotenv
+from prefect import flow
+
+from ..utils.embedding_codec import (
+    EMBEDDING_ENCODING,
+    ENCODING_DTYPES,
+    decode_embeddings,
+    encode_embeddings,
+    prepare_embeddings,
+)
+from ..utils.embedding_store import EmbeddingStore, get_embeddings
+from ..utils.embeddings_index import (
+    IVF_INDEX_TYPES,
+    IVF_MAX_TRAINING_SIZE,
+    IVF_MIN_TRAINING_SIZE,
+    TRAINED_INDEX_TYPES,
+    configure_search,
+    create_index,
+    search_index,
+)
+from .initialize_database import EMBEDDING_DIMENSION
+
+load_dotenv()  # Inject environment variables from .env during development
+
+# Number of faces searched to measure the recall
+BENCHMARK_QUERIES = 1000
+# Maximum number of faces in the benchmarked indexes, to bound memory use and build time
+BENCHMARK_MAX_FACES = 200_000
+# Number of nearest neighbors compared against the exact results
+BENCHMARK_K = 10
+# Index types benchmarked for every metric
+BENCHMARK_INDEX_TYPES = ("flat", "fp16", "sq8", "ivf_flat", "ivf_sq8", "ivf_pq", "hnsw")
+
+
+def measure_recall(
+    index: faiss.Index, queries: np.ndarray, exact_ids: np.ndarray
+) -> tuple[float, float]:
+    """
+    Search the queries in the index, returns the fraction of the exact k nearest neighbors
+    that were found and the search time per query in milliseconds
+    """
+    start = time.perf_counter()
+    _, ids = search_index(index, queries, exact_ids.shape[1])
+    duration = time.perf_counter() - start
+
+    found = [len(np.intersect1d(row, exact_row)) for row, exact_row in zip(ids, exact_ids)]
+    return sum(found) / exact_ids.size, duration * 1000 / len(queries)
+
+
+def build_index(
+    embeddings: np.ndarray, face_ids: np.ndarray, index_type: str, metric: str
+) -> faiss.Index:
+    """
+    Build an index of the given type and metric holding all benchmarked faces
+    """
+    training_embeddings = None
+    if index_type in TRAINED_INDEX_TYPES:
+        training_embeddings = embeddings[:IVF_MAX_TRAINING_SIZE]
+
+    index = create_index(EMBEDDING_DIMENSION, index_type, training_embeddings, metric)
+    index.add_with_ids(embeddings, face_ids)
+    configure_search(index)
+    return index
+
+
+@flow()
+def benchmark_index(queries: int = BENCHMARK_QUERIES, max_faces: int = BENCHMARK_MAX_FACES):
+    """
+    Compare every index type and embedding encoding with both metrics against an exact
+    flat L2 search of the stored embeddings, the setup used before compression was supported
+    """
+    store = EmbeddingStore(os.environ["EMBEDDINGS_STORE_PATH"], EMBEDDING_DIMENSION)
+    store_rows, stored_embeddings = store.load_rows()
+
+    rng = np.random.default_rng(0)
+    face_ids = np.flatnonzero(store_rows >= 0)
+    if len(face_ids) == 0:
+        print("No embeddings stored yet, nothing to benchmark")
+        return
+
+    face_ids = np.sort(rng.choice(face_ids, min(len(face_ids), max_faces), replace=False))
+    embeddings = get_embeddings(store_rows, stored_embeddings, face_ids)
+    query_positions = rng.choice(len(face_ids), min(len(face_ids), queries), replace=False)
+    print(
+        f"Benchmarking {len(query_positions)} queries against {len(face_ids)} faces "
+        f"stored as {EMBEDDING_ENCODING}"
+    )
+
+    # Exact results of a flat L2 search, which every setup is compared against
+    exact_index = build_index(embeddings, face_ids, "flat", "l2")
+    _, exact_ids = search_index(exact_index, embeddings[query_positions], BENCHMARK_K)
+
+    results = []
+    for metric in ("l2", "cosine"):
+        prepared = prepare_embeddings(embeddings, metric)
+        queries_prepared = prepared[query_positions]
+
+        # Exact search over the embeddings as they would be stored with every encoding
+        for encoding in ("float32", "float16", "sq8"):
+            if encoding == "sq8" and metric != "cosine":
+                continue
+            decoded = decode_embeddings(encode_embeddings(prepared, encoding, metric))
+            index = build_index(decoded, face_ids, "flat", metric)
+            recall, milliseconds = measure_recall(index, decoded[query_positions], exact_ids)
+            bytes_per_face = np.dtype(ENCODING_DTYPES[encoding]).itemsize * EMBEDDING_DIMENSION
+            results.append((metric, f"stored {encoding}", recall, bytes_per_face, milliseconds))
+
+        for index_type in BENCHMARK_INDEX_TYPES:
+            if index_type in IVF_INDEX_TYPES and len(face_ids) < IVF_MIN_TRAINING_SIZE:
+                print(f"Skipping {index_type}, which needs {IVF_MIN_TRAINING_SIZE} faces")
+                continue
+            index = build_index(prepared, face_ids, index_type, metric)
+            recall, milliseconds = measure_recall(index, queries_prepared, exact_ids)
+            index_size = len(faiss.serialize_index(index))
+            results.append(
+                (metric, f"index {index_type}", recall, index_size / len(face_ids), milliseconds)
+            )
+
+    print(
+        f"{'metric':<8}{'setup':<18}{f'recall@{BENCHMARK_K}':>10}"
+        f"{'bytes/face':>12}{'ms/query':>10}"
+    )
+    for metric, setup, recall, bytes_per_face, milliseconds in results:
+        print(
+            f"{metric:<8}{setup:<18}{recall:>10.3f}"
+            f"{bytes_per_face:>12.1f}{milliseconds:>10.3f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--queries", type=int, default=BENCHMARK_QUERIES)
+    parser.add_argument("--max-faces", type=int, default=BENCHMARK_MAX_FACES)
+    args = parser.parse_args()
+
+    benchmark_index(queries=args.queries, max_faces=args.max_faces)
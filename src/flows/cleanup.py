@@ -6,6 +6,8 @@ import shutil
 from dotenv import load_dotenv
 from prefect import flow
 
+from ..utils.thumbnail_cache import get_cache_path
+
 load_dotenv()  # Inject environment variables from .env during development
 
 
@@ -20,8 +22,19 @@ def cleanup():
     if os.path.exists(os.environ["EMBEDDINGS_INDEX_PATH"]):
         os.remove(os.environ["EMBEDDINGS_INDEX_PATH"])
 
-    if os.path.exists(os.environ["THUMBNAILS_PATH"]):
-        shutil.rmtree(os.environ["THUMBNAILS_PATH"])
+    for path in (
+        os.environ["PERSONS_INDEX_PATH"],
+        os.environ["PERSONS_INDEX_PATH"] + ".lock",
+        os.environ["EMBEDDINGS_STORE_PATH"],
+        os.environ["EMBEDDINGS_STORE_PATH"] + ".ids",
+        os.environ["EMBEDDINGS_STORE_PATH"] + ".encoding",
+    ):
+        if os.path.exists(path):
+            os.remove(path)
+
+    for path in (os.environ["THUMBNAILS_PATH"], get_cache_path()):
+        if os.path.exists(path):
+            shutil.rmtree(path)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,64 @@
+"""Removes deleted files and the outdated faces of modified files incrementally"""
+
+import argparse
+import os
+
+from dotenv import load_dotenv
+from prefect import flow
+from sqlalchemy import create_engine
+
+from ..utils.embedding_store import EmbeddingStore
+from ..utils.embeddings_checkpoint import Checkpointer, open_embeddings
+from ..utils.embeddings_index import read_index
+from ..utils.garbage import clear_outdated_files, delete_files
+from .initialize_database import EMBEDDING_DIMENSION
+
+load_dotenv()  # Inject environment variables from .env during development
+
+
+@flow(log_prints=True)
+def collect_garbage(deleted_paths: list[str] | None = None):
+    """
+    Delete the given deleted files or directories and the outdated faces of modified files
+    from the database, Faiss index and thumbnails folder. Only the changed files are
+    queried, so the cost depends on the size of the change instead of the library.
+    """
+    db_engine = create_engine("sqlite:///" + os.environ["DATABASE_PATH"])
+
+    with db_engine.connect() as conn:
+        discarded = [clear_outdated_files(conn)]
+        if deleted_paths:
+            discarded.append(delete_files(conn, deleted_paths))
+
+        # Nothing changed, so the index doesn't have to be read at all
+        if not any(face_ids or thumbnails for face_ids, thumbnails, _ in discarded):
+            conn.commit()
+            return
+
+        store = EmbeddingStore(os.environ["EMBEDDINGS_STORE_PATH"], EMBEDDING_DIMENSION)
+        if store.get_stored_encoding() not in (None, store.encoding):
+            # The store has to be rebuilt first, which a full reconciliation does
+            index, store = open_embeddings(conn, EMBEDDING_DIMENSION)
+        else:
+            # Faces missing from the index are recovered by the next embedding run,
+            # only the discarded faces have to be removed here
+            index = read_index(os.environ["EMBEDDINGS_INDEX_PATH"])
+
+        checkpointer = Checkpointer(conn, index, store)
+        for face_ids, thumbnails, person_ids in discarded:
+            checkpointer.discard(face_ids, thumbnails, person_ids)
+
+        # Remove the faces from the index in one batch, only once the database is committed
+        checkpointer.checkpoint()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "paths",
+        nargs="*",
+        help="Deleted files or directories to remove from the database",
+    )
+    args = parser.parse_args()
+
+    collect_garbage(args.paths)
@@ -1,16 +1,29 @@
 """Flow to generate face embeddings for all new or modified files within the database"""
 
+import multiprocessing
 import os
+from collections import deque
+from collections.abc import Iterator
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 
 import faiss
 import numpy as np
 from deepface import DeepFace
 from dotenv import load_dotenv
 from prefect import flow, task
-from sqlalchemy import create_engine, insert, select, update
+from sqlalchemy import case, create_engine, func, insert, select, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 
+from ..utils.embedding_codec import decode_embedding, encode_embedding, prepare_embeddings
+from ..utils.embedding_store import EmbeddingStore
+from ..utils.embeddings_checkpoint import Checkpointer, open_embeddings
+from ..utils.garbage import clear_outdated_files
+from ..utils.images import load_image, to_bgr_array
+from ..utils.tables import detection_stages as detection_stages_table
 from ..utils.tables import faces as faces_table
 from ..utils.tables import files as files_table
+from .initialize_database import EMBEDDING_DIMENSION
 
 load_dotenv()  # Inject environment variables from .env during development
 
@@ -21,6 +34,209 @@ load_dotenv()  # Inject environment variables from .env during development
 FACE_RECOGNITION_MODEL = "Facenet"  # See Deepface documentation for all options
 FACE_DETECTION_MODEL = "retinaface"  # See Deepface documentation for all options
 
+# Longest side of the decoded image used for face detection, 0 detects on the full resolution image
+FACE_DETECTION_MAX_SIDE = int(os.environ.get("FACE_DETECTION_MAX_SIDE", 0))
+# Minimum side of the smallest face in the image that faces are embedded from, Facenet uses 160x160
+FACE_CROP_MIN_SIDE = 160
+# Margin around a detected face, relative to its size, kept when cropping it for alignment
+FACE_CROP_MARGIN = 0.25
+
+# Fast detector screening every image before the accurate detector, empty disables the cascade
+FACE_SCREENING_MODEL = os.environ.get("FACE_SCREENING_MODEL", "")  # E.g. "ssd" or "opencv"
+# Longest side of the decoded image the screening detector runs on
+FACE_SCREENING_MAX_SIDE = int(os.environ.get("FACE_SCREENING_MAX_SIDE", 640))
+# Minimum confidence of a screened face to pass the image on to the accurate detector
+FACE_SCREENING_MIN_CONFIDENCE = float(
+    os.environ.get("FACE_SCREENING_MIN_CONFIDENCE", 0.3)
+)
+
+# Number of worker processes running face detection and recognition, 0 runs them in the flow itself
+EMBEDDING_WORKERS = int(os.environ.get("EMBEDDING_WORKERS", 0))
+# Number of threads TensorFlow and OpenMP may use within a single worker process
+EMBEDDING_WORKER_THREADS = int(os.environ.get("EMBEDDING_WORKER_THREADS", 1))
+# Number of files queued per worker, which bounds the results waiting for the writer
+EMBEDDING_FILES_PER_WORKER = 4
+
+
+def represent_faces(
+    filepath: str, face_recognition_model: str, face_detection_model: str
+) -> list[dict]:
+    """
+    Detect faces in a file and generate their embeddings using the Deepface library
+    """
+    if FACE_DETECTION_MAX_SIDE:
+        return represent_faces_reduced(
+            filepath, face_recognition_model, face_detection_model, FACE_DETECTION_MAX_SIDE
+        )
+
+    # Without any detection, Deepface returns the whole image with a confidence of 0
+    return [
+        face
+        for face in DeepFace.represent(
+            img_path=filepath,
+            enforce_detection=False,
+            model_name=face_recognition_model,
+            detector_backend=face_detection_model,
+        )
+        if face["face_confidence"] > 0
+    ]
+
+
+def screen_faces(filepath: str, screening_model: str) -> dict:
+    """
+    Run a fast detector on a small decode of the image to see if it's worth running
+    the accurate detector at all
+    """
+    image, _ = load_image(filepath, FACE_SCREENING_MAX_SIDE)
+    detections = DeepFace.extract_faces(
+        img_path=to_bgr_array(image),
+        enforce_detection=False,
+        detector_backend=screening_model,
+        align=False,
+    )
+
+    # Without any detection, Deepface returns the whole image with a confidence of 0
+    confidences = [float(d["confidence"]) for d in detections if d["confidence"] > 0]
+    return {
+        "screening_model": screening_model,
+        "screening_faces": sum(int(c >= FACE_SCREENING_MIN_CONFIDENCE) for c in confidences),
+        "screening_max_confidence": max(confidences, default=0.0),
+    }
+
+
+def detect_faces(
+    filepath: str, face_recognition_model: str, face_detection_model: str
+) -> tuple[list[dict], dict | None]:
+    """
+    Detect faces in a file and generate their embeddings, screening the image with a fast
+    detector first when the detection cascade is enabled. Returns the faces and the outcome
+    of the cascade stages, which is None when the cascade is disabled.
+    """
+    if not FACE_SCREENING_MODEL:
+        return represent_faces(filepath, face_recognition_model, face_detection_model), None
+
+    stages = screen_faces(filepath, FACE_SCREENING_MODEL)
+    if stages["screening_faces"] == 0:
+        return [], stages
+
+    faces = represent_faces(filepath, face_recognition_model, face_detection_model)
+    stages["detection_faces"] = len(faces)
+    return faces, stages
+
+
+def represent_face_crop(
+    image: np.ndarray,
+    area: tuple[int, int, int, int],
+    face_recognition_model: str,
+    face_detection_model: str,
+) -> dict:
+    """
+    Generate the embedding of a single face from a crop around its facial area, detecting
+    the face again within the small crop so it gets aligned like a full resolution detection
+    """
+    x, y, w, h = area
+    margin_x, margin_y = int(w * FACE_CROP_MARGIN), int(h * FACE_CROP_MARGIN)
+    left, top = max(0, x - margin_x), max(0, y - margin_y)
+    crop = image[top : y + h + margin_y, left : x + w + margin_x]
+
+    faces = [
+        face
+        for face in DeepFace.represent(
+            img_path=crop,
+            enforce_detection=False,
+            model_name=face_recognition_model,
+            detector_backend=face_detection_model,
+        )
+        if face["face_confidence"] > 0
+    ]
+    if faces:
+        # The crop could contain parts of other faces, so pick the largest one
+        face = max(faces, key=lambda f: f["facial_area"]["w"] * f["facial_area"]["h"])
+        return {
+            "embedding": face["embedding"],
+            "facial_area": {
+                "x": left + face["facial_area"]["x"],
+                "y": top + face["facial_area"]["y"],
+                "w": face["facial_area"]["w"],
+                "h": face["facial_area"]["h"],
+            },
+        }
+
+    # Fall back to the unaligned facial area if the face isn't found again
+    face = DeepFace.represent(
+        img_path=image[y : y + h, x : x + w],
+        enforce_detection=False,
+        model_name=face_recognition_model,
+        detector_backend="skip",
+    )[0]
+    return {"embedding": face["embedding"], "facial_area": {"x": x, "y": y, "w": w, "h": h}}
+
+
+def represent_faces_reduced(
+    filepath: str,
+    face_recognition_model: str,
+    face_detection_model: str,
+    detection_max_side: int,
+) -> list[dict]:
+    """
+    Detect faces on a reduced resolution decode of the image and map their facial areas
+    back to the original resolution. Faces are embedded from a decode at just enough
+    resolution to keep the smallest face at least FACE_CROP_MIN_SIDE pixels.
+    """
+    image, scale = load_image(filepath, detection_max_side)
+    detections = [
+        detection
+        for detection in DeepFace.extract_faces(
+            img_path=to_bgr_array(image),
+            enforce_detection=False,
+            detector_backend=face_detection_model,
+            align=False,
+        )
+        # Without any detection, Deepface returns the whole image with a confidence of 0
+        if detection["confidence"] > 0
+    ]
+
+    # Facial areas in original image coordinates
+    areas = [
+        (
+            round(d["facial_area"]["x"] * scale),
+            round(d["facial_area"]["y"] * scale),
+            round(d["facial_area"]["w"] * scale),
+            round(d["facial_area"]["h"] * scale),
+        )
+        for d in detections
+    ]
+    if not areas:
+        return []
+
+    # Decode again at a higher resolution when the smallest face would become too small
+    smallest_face = min(min(w, h) for _, _, w, h in areas)
+    crop_scale = max(1.0, smallest_face / FACE_CROP_MIN_SIDE)
+    if crop_scale < scale:
+        crop_max_side = int(max(image.size) * scale / crop_scale)
+        image, scale = load_image(filepath, crop_max_side)
+    crop_image = to_bgr_array(image)
+
+    faces = []
+    for detection, (x, y, w, h) in zip(detections, areas):
+        face = represent_face_crop(
+            crop_image,
+            (round(x / scale), round(y / scale), round(w / scale), round(h / scale)),
+            face_recognition_model,
+            face_detection_model,
+        )
+        faces.append(
+            {
+                "embedding": face["embedding"],
+                "face_confidence": detection["confidence"],
+                "facial_area": {
+                    key: round(value * scale) for key, value in face["facial_area"].items()
+                },
+            }
+        )
+
+    return faces
+
 
 @task()
 def generate_embeddings_from_file(
@@ -29,63 +245,315 @@ def generate_embeddings_from_file(
     """
     Generate embeddings of a file using the Deepface library
     """
-    return DeepFace.represent(
-        img_path=filepath,
-        enforce_detection=False,
-        model_name=face_recognition_model,
-        detector_backend=face_detection_model,
+    return detect_faces(filepath, face_recognition_model, face_detection_model)
+
+
+def init_embedding_worker(face_recognition_model: str, face_detection_model: str):
+    """
+    Load the face detection and recognition models once when a worker process starts
+    """
+    # pylint: disable-next=import-outside-toplevel
+    from deepface.detectors import DetectorWrapper
+
+    DeepFace.build_model(face_recognition_model)
+    DetectorWrapper.build_model(face_detection_model)
+    if FACE_SCREENING_MODEL:
+        DetectorWrapper.build_model(FACE_SCREENING_MODEL)
+
+
+@contextmanager
+def embedding_worker_pool(workers: int, threads: int) -> Iterator[ProcessPoolExecutor]:
+    """
+    Start a pool of embedding worker processes with limited TensorFlow and OpenMP threads
+    """
+    # Spawned workers inherit the environment, which is read when TensorFlow and OpenMP start
+    thread_variables = ["OMP_NUM_THREADS", "TF_NUM_INTRAOP_THREADS", "TF_NUM_INTEROP_THREADS"]
+    previous = {name: os.environ.get(name) for name in thread_variables}
+    os.environ.update({name: str(threads) for name in thread_variables})
+
+    try:
+        # Forking a process that already initialized TensorFlow is unsafe, so spawn instead
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_embedding_worker,
+            initargs=(FACE_RECOGNITION_MODEL, FACE_DETECTION_MODEL),
+        ) as executor:
+            yield executor
+    finally:
+        for name, value in previous.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def represent_faces_in_pool(
+    executor: ProcessPoolExecutor, rows: list, max_pending: int
+) -> Iterator[tuple[object, tuple[list[dict], dict | None]]]:
+    """
+    Detect faces of the files in the worker pool and yield the results in order,
+    keeping at most max_pending files in flight
+    """
+    pending = deque()
+    for row in rows:
+        pending.append(
+            (
+                row,
+                executor.submit(
+                    detect_faces, row.path, FACE_RECOGNITION_MODEL, FACE_DETECTION_MODEL
+                ),
+            )
+        )
+        if len(pending) >= max_pending:
+            finished_row, future = pending.popleft()
+            yield finished_row, future.result()
+
+    while pending:
+        finished_row, future = pending.popleft()
+        yield finished_row, future.result()
+
+
+def store_faces(
+    conn,
+    index: faiss.Index,
+    store: EmbeddingStore,
+    file_id: int,
+    faces: list[dict],
+):
+    """
+    Store the detected faces of a file in the database and their embeddings in Faiss
+    and the embedding store
+    """
+    for face in faces:
+        # Normalized for the cosine metric, so the database, Faiss and the store agree
+        embedding = prepare_embeddings(face["embedding"])
+
+        # Store face metadata in the SQL database
+        insert_face_statement = insert(faces_table).values(
+            file_id=file_id,
+            confidence=face["face_confidence"],
+            embedding=encode_embedding(embedding),
+            facial_area_left=face["facial_area"]["x"],
+            facial_area_top=face["facial_area"]["y"],
+            facial_area_width=face["facial_area"]["w"],
+            facial_area_height=face["facial_area"]["h"],
+        )
+        result = conn.execute(insert_face_statement)
+
+        # Store face embedding in Faiss and the embedding store
+        index.add_with_ids(embedding, [result.inserted_primary_key[0]])
+        store.append([result.inserted_primary_key[0]], embedding)
+
+
+def load_processed_hashes(conn) -> dict[str, int]:
+    """
+    Map the hash of every file that was already processed to one of the files with that hash
+    """
+    statement = (
+        select(files_table.c.hash, func.min(files_table.c.id).label("file_id"))
+        .where(files_table.c.contains_face.isnot(None))
+        .group_by(files_table.c.hash)
     )
+    return {row.hash: row.file_id for row in conn.execute(statement)}
+
+
+def copy_faces_from_file(
+    conn,
+    index: faiss.Index,
+    store: EmbeddingStore,
+    source_file_id: int,
+    target_file_id: int,
+) -> set[int]:
+    """
+    Copy the faces, embeddings and thumbnails of an already processed, byte-identical file
+    instead of running face detection and recognition again, returns the persons the copied
+    faces are labeled with
+    """
+    source_file = conn.execute(
+        select(files_table.c.contains_face, files_table.c.thumbnail_filename).where(
+            files_table.c.id == source_file_id
+        )
+    ).one()
+    source_faces = conn.execute(
+        select(faces_table).where(faces_table.c.file_id == source_file_id)
+    ).all()
+
+    for face in source_faces:
+        # Thumbnail files are shared between the copies, as their content is identical
+        insert_face_statement = insert(faces_table).values(
+            file_id=target_file_id,
+            person_id=face.person_id,
+            person_id_suggested=face.person_id_suggested,
+            thumbnail_filename=face.thumbnail_filename,
+            embedding=face.embedding,
+            confidence=face.confidence,
+            facial_area_left=face.facial_area_left,
+            facial_area_top=face.facial_area_top,
+            facial_area_width=face.facial_area_width,
+            facial_area_height=face.facial_area_height,
+        )
+        result = conn.execute(insert_face_statement)
+
+        # The copied face still gets its own entry in Faiss and the embedding store
+        embedding = decode_embedding(face.embedding, EMBEDDING_DIMENSION).reshape(1, -1)
+        index.add_with_ids(embedding, [result.inserted_primary_key[0]])
+        store.append([result.inserted_primary_key[0]], embedding)
+
+    update_file_statement = (
+        update(files_table)
+        .where(files_table.c.id == target_file_id)
+        .values(
+            contains_face=source_file.contains_face,
+            thumbnail_filename=source_file.thumbnail_filename,
+        )
+    )
+    conn.execute(update_file_statement)
+
+    return {face.person_id for face in source_faces if face.person_id}
+
+
+def store_file_faces(
+    conn,
+    index: faiss.Index,
+    store: EmbeddingStore,
+    file_id: int,
+    faces: list[dict],
+    stages: dict | None = None,
+):
+    """
+    Mark a file as processed and store its detected faces and the outcome of the detection cascade
+    """
+    face_found = len(faces) > 0
+
+    # Update whether we found at least one face in the file
+    update_file_statement = (
+        update(files_table)
+        .where(files_table.c.id == file_id)
+        .values(contains_face=face_found)
+    )
+    conn.execute(update_file_statement)
+
+    if stages is not None:
+        conn.execute(
+            sqlite_insert(detection_stages_table)
+            .values(file_id=file_id, **stages)
+            .on_conflict_do_update(index_elements=["file_id"], set_=stages)
+        )
+
+    if face_found:
+        store_faces(conn, index, store, file_id, faces)
+
+
+def embed_file(
+    conn,
+    index: faiss.Index,
+    store: EmbeddingStore,
+    file_id: int,
+    path: str,
+    file_hash: str,
+    processed_hashes: dict[str, int],
+) -> set[int]:
+    """
+    Detect the faces of a single file and store them with their embeddings, returns the
+    persons of the faces that were copied labeled from a byte-identical file
+    """
+    # Byte-identical copies of a processed file reuse its results
+    if file_hash in processed_hashes:
+        return copy_faces_from_file(
+            conn, index, store, processed_hashes[file_hash], file_id
+        )
+
+    faces, stages = generate_embeddings_from_file(
+        path, FACE_RECOGNITION_MODEL, FACE_DETECTION_MODEL
+    )
+    store_file_faces(conn, index, store, file_id, faces, stages)
+
+    processed_hashes[file_hash] = file_id
+    return set()
+
+
+def report_detection_cascade(conn):
+    """
+    Report the hit rates of the detection cascade stages, to tune the screening thresholds
+    """
+    stages = conn.execute(
+        select(
+            func.count().label("screened"),
+            func.count(detection_stages_table.c.detection_faces).label("passed"),
+            func.sum(
+                case((detection_stages_table.c.detection_faces > 0, 1), else_=0)
+            ).label("confirmed"),
+        ).select_from(detection_stages_table)
+    ).one()
+
+    if stages.screened > 0:
+        print(
+            f"Detection cascade: {stages.passed} of {stages.screened} screened files "
+            f"({stages.passed / stages.screened:.1%}) passed to {FACE_DETECTION_MODEL}, "
+            f"which found faces in {stages.confirmed or 0} of them "
+            f"({(stages.confirmed or 0) / max(stages.passed, 1):.1%})"
+        )
 
 
 @flow()
-def generate_embeddings():
+def generate_embeddings(
+    workers: int = EMBEDDING_WORKERS, worker_threads: int = EMBEDDING_WORKER_THREADS
+):
     """
-    Generate face embeddings for all new or modified files within the database
+    Generate face embeddings for all new or modified files within the database,
+    optionally running the models in a pool of worker processes while this flow
+    remains the single writer to the database and Faiss index
     """
     db_engine = create_engine("sqlite:///" + os.environ["DATABASE_PATH"])
-    index = faiss.read_index(os.environ["EMBEDDINGS_INDEX_PATH"])
 
     with db_engine.connect() as conn:
+        index, store = open_embeddings(conn, EMBEDDING_DIMENSION)
+        checkpointer = Checkpointer(conn, index, store)
+
+        # Modified files still hold the faces of their previous content
+        checkpointer.discard(*clear_outdated_files(conn))
+        if checkpointer.discarded_ids or checkpointer.discarded_thumbnails:
+            checkpointer.checkpoint()
+            index = checkpointer.index
+
+        processed_hashes = load_processed_hashes(conn)
+
         statement = select(files_table).where(files_table.c.contains_face.is_(None))
-        for row in conn.execute(statement):
-            faces = generate_embeddings_from_file(
-                row.path, FACE_RECOGNITION_MODEL, FACE_DETECTION_MODEL
-            )
+        rows = conn.execute(statement).all()
+
+        if workers > 0:
+            # Only the first file of every unprocessed hash needs inference,
+            # the other files are copied from it afterwards
+            unique_rows = {}
+            for row in rows:
+                if row.hash not in processed_hashes:
+                    unique_rows.setdefault(row.hash, row)
 
-            face_found = len(faces) > 0
+            with embedding_worker_pool(workers, worker_threads) as executor:
+                for row, (faces, stages) in represent_faces_in_pool(
+                    executor,
+                    list(unique_rows.values()),
+                    workers * EMBEDDING_FILES_PER_WORKER,
+                ):
+                    store_file_faces(conn, index, store, row.id, faces, stages)
+                    processed_hashes[row.hash] = row.id
+                    checkpointer.file_done()
 
-            # Update that we found at least one face in the file
-            update_file_statement = (
-                update(files_table)
-                .where(files_table.c.id == row.id)
-                .values(contains_face=True)
+            rows = [row for row in rows if processed_hashes.get(row.hash) != row.id]
+
+        for row in rows:
+            # Labels copied along with the faces change the prototypes of their persons
+            checkpointer.persons_changed(
+                embed_file(conn, index, store, row.id, row.path, row.hash, processed_hashes)
             )
-            conn.execute(update_file_statement)
-            conn.commit()
-
-            if face_found:
-                for face in faces:
-                    # Store face metadata in the SQL database
-                    insert_face_statement = insert(faces_table).values(
-                        file_id=row.id,
-                        confidence=face["face_confidence"],
-                        embedding=np.array([face["embedding"]])
-                        .astype(np.float32)
-                        .tobytes(),
-                        facial_area_left=face["facial_area"]["x"],
-                        facial_area_top=face["facial_area"]["y"],
-                        facial_area_width=face["facial_area"]["w"],
-                        facial_area_height=face["facial_area"]["h"],
-                    )
-                    result = conn.execute(insert_face_statement)
-                    conn.commit()
-
-                    # Store face embedding in Faiss
-                    embedding = np.array([face["embedding"]]).astype(np.float32)
-                    index.add_with_ids(embedding, [result.inserted_primary_key[0]])
-
-    # Store index to disk
-    faiss.write_index(index, os.environ["EMBEDDINGS_INDEX_PATH"])
+            checkpointer.file_done()
+
+        # Store the remaining faces and index to disk
+        checkpointer.finish()
+
+        if FACE_SCREENING_MODEL:
+            report_detection_cascade(conn)
 
 
 if __name__ == "__main__":
@@ -1,56 +1,91 @@
 """Generate thumbnails for faces and files in the database"""
 
+import multiprocessing
 import os
+from collections import deque
+from collections.abc import Iterator
+from concurrent.futures import Future, ProcessPoolExecutor
 
 from dotenv import load_dotenv
-from PIL import Image, ImageOps
-from prefect import flow, task
-from sqlalchemy import create_engine, select
+from PIL import Image
+from prefect import flow
+from sqlalchemy import Engine, bindparam, create_engine, select
 
+from ..utils.images import load_image
 from ..utils.tables import faces as faces_table
 from ..utils.tables import files as files_table
+from ..utils.thumbnail_cache import THUMBNAIL_MODE
 
 load_dotenv()  # Inject environment variables from .env during development
 
 MAX_FACE_THUMBNAIL_SIZE = (500, 500)
 MAX_FILE_THUMBNAIL_SIZE = (1000, 1000)
+# Number of worker processes decoding images and rendering their thumbnails
+THUMBNAIL_WORKERS = int(os.environ.get("THUMBNAIL_WORKERS", os.cpu_count() or 1))
+# Number of files whose thumbnail filenames are stored per transaction
+THUMBNAIL_BATCH_SIZE = 100
+# Number of files queued per worker process, so workers never wait for the next file
+THUMBNAIL_FILES_PER_WORKER = 4
+# Errors of unreadable or corrupt images, which don't stop the other files
+THUMBNAIL_ERRORS = (OSError, ValueError, Image.DecompressionBombError)
 
 
-@task()
-def generate_thumbnail(
+def save_thumbnail(
+    image: Image.Image,
     thumbnail_dir: str,
     file_path: str,
     file_postfix: str,
-    crop: list[int, int, int, int] = None,
+    max_size: tuple[int, int],
 ) -> str:
     """
-    Create a thumbnail of the face area of an image
+    Save a thumbnail of an image named after the source file, returns its filename
     """
-    # Open image in RGB mode
-    with Image.open(file_path) as image:
-        # Transpose the image according to its EXIF Orientation tag
-        image = ImageOps.exif_transpose(image)
+    image.thumbnail(max_size)
 
-        # If a face crop is provided, crop the image to the face area
-        if crop is not None:
-            face_left, face_top, face_width, face_height = crop
-            output_image = image.crop(
-                (face_left, face_top, face_left + face_width, face_top + face_height)
-            )
-            output_image.thumbnail(MAX_FACE_THUMBNAIL_SIZE)
-        # Otherwise we create a thumbnail of the whole image
-        else:
-            output_image = image.copy()
-            output_image.thumbnail(MAX_FILE_THUMBNAIL_SIZE)
+    file_name = os.path.basename(file_path)
+    filename_base, file_extension = os.path.splitext(file_name.lower())
+    thumbnail_filename = filename_base + str(file_postfix) + file_extension
+    image.save(os.path.join(thumbnail_dir, thumbnail_filename))
+
+    return thumbnail_filename
 
-        file_name = os.path.basename(file_path)
-        filename_base, file_extension = os.path.splitext(file_name.lower())
-        thumbnail_filename = filename_base + str(file_postfix) + file_extension
-        target_path = os.path.join(thumbnail_dir, thumbnail_filename)
 
-        output_image.save(target_path)
+def render_file_thumbnails(
+    thumbnail_dir: str,
+    file_id: int,
+    file_path: str,
+    faces: list[tuple[int, list[int]]],
+    file_thumbnail: bool,
+) -> tuple[int, dict[int, str], str | None]:
+    """
+    Create the thumbnails of the given faces of an image and optionally of the whole image,
+    all from a single decode. Returns the file id, the thumbnail filename of every face
+    and the thumbnail filename of the file.
+    """
+    # Open the image and transpose it according to its EXIF Orientation tag only once
+    image, _ = load_image(file_path)
+
+    face_thumbnails = {}
+    for face_id, (face_left, face_top, face_width, face_height) in faces:
+        face_image = image.crop(
+            (face_left, face_top, face_left + face_width, face_top + face_height)
+        )
+        face_thumbnails[face_id] = save_thumbnail(
+            face_image,
+            thumbnail_dir,
+            file_path,
+            f"-{file_id}-{face_id}",
+            MAX_FACE_THUMBNAIL_SIZE,
+        )
+
+    # The file thumbnail is made last, as thumbnail() resizes the decoded image in place
+    file_thumbnail_filename = None
+    if file_thumbnail:
+        file_thumbnail_filename = save_thumbnail(
+            image, thumbnail_dir, file_path, f"-{file_id}", MAX_FILE_THUMBNAIL_SIZE
+        )
 
-        return thumbnail_filename
+    return file_id, face_thumbnails, file_thumbnail_filename
 
 
 def create_thumbnails_folder_if_needed(path: str):
@@ -61,30 +96,41 @@ def create_thumbnails_folder_if_needed(path: str):
         os.makedirs(path)
 
 
-def generate_face_thumbnails(db_engine: create_engine):
+def load_missing_thumbnails(conn, file_id: int | None = None) -> dict[int, dict]:
     """
-    Generate thumbnails for all faces in the database that do not have a thumbnail yet
+    Group the faces and files without a thumbnail yet by source file, for all files
+    or only the given file
     """
-    with db_engine.connect() as conn:
-        statement = (
-            select(
-                files_table.c.id.label("file_id"),
-                files_table.c.path,
-                faces_table.c.id.label("face_id"),
-                faces_table.c.facial_area_left,
-                faces_table.c.facial_area_top,
-                faces_table.c.facial_area_width,
-                faces_table.c.facial_area_height,
-            )
-            .select_from(files_table)
-            .join(faces_table)
-            .where(faces_table.c.thumbnail_filename.is_(None))
+    files = {}
+
+    faces_statement = (
+        select(
+            files_table.c.id.label("file_id"),
+            files_table.c.path,
+            faces_table.c.id.label("face_id"),
+            faces_table.c.facial_area_left,
+            faces_table.c.facial_area_top,
+            faces_table.c.facial_area_width,
+            faces_table.c.facial_area_height,
         )
-        for row in conn.execute(statement):
-            thumbnail_filename = generate_thumbnail(
-                os.environ["THUMBNAILS_PATH"],
-                row.path,
-                f"-{row.file_id}-{row.face_id}",
+        .select_from(files_table)
+        .join(faces_table)
+        .where(faces_table.c.thumbnail_filename.is_(None))
+    )
+    files_statement = select(files_table.c.id, files_table.c.path).where(
+        files_table.c.thumbnail_filename.is_(None)
+    )
+    if file_id is not None:
+        faces_statement = faces_statement.where(files_table.c.id == file_id)
+        files_statement = files_statement.where(files_table.c.id == file_id)
+
+    for row in conn.execute(faces_statement):
+        file = files.setdefault(
+            row.file_id, {"path": row.path, "faces": [], "file_thumbnail": False}
+        )
+        file["faces"].append(
+            (
+                row.face_id,
                 [
                     row.facial_area_left,
                     row.facial_area_top,
@@ -92,37 +138,126 @@ def generate_face_thumbnails(db_engine: create_engine):
                     row.facial_area_height,
                 ],
             )
+        )
 
-            update_statement = (
-                faces_table.update()
-                .where(faces_table.c.id == row.face_id)
-                .values(thumbnail_filename=thumbnail_filename)
-            )
-            conn.execute(update_statement)
-            conn.commit()
+    for row in conn.execute(files_statement):
+        file = files.setdefault(
+            row.id, {"path": row.path, "faces": [], "file_thumbnail": False}
+        )
+        file["file_thumbnail"] = True
 
+    return files
 
-def generate_file_thumbnails(db_engine: create_engine):
+
+def store_thumbnail_filenames(conn, results: list[tuple[int, dict[int, str], str | None]]):
     """
-    Generate thumbnails for all files in the database that do not have a thumbnail yet
+    Store the thumbnail filenames of a batch of rendered files in a single transaction
     """
+    face_values = [
+        {"face_id": face_id, "filename": filename}
+        for _, face_thumbnails, _ in results
+        for face_id, filename in face_thumbnails.items()
+    ]
+    file_values = [
+        {"file_id": file_id, "filename": filename}
+        for file_id, _, filename in results
+        if filename is not None
+    ]
 
-    with db_engine.connect() as conn:
-        statement = select(files_table.c.id, files_table.c.path).where(
-            files_table.c.thumbnail_filename.is_(None)
+    if face_values:
+        conn.execute(
+            faces_table.update()
+            .where(faces_table.c.id == bindparam("face_id"))
+            .values(thumbnail_filename=bindparam("filename")),
+            face_values,
         )
-        for row in conn.execute(statement):
-            thumbnail_filename = generate_thumbnail(
-                os.environ["THUMBNAILS_PATH"], row.path, f"-{row.id}"
-            )
+    if file_values:
+        conn.execute(
+            files_table.update()
+            .where(files_table.c.id == bindparam("file_id"))
+            .values(thumbnail_filename=bindparam("filename")),
+            file_values,
+        )
+    conn.commit()
+
+
+def get_job_result(job: tuple, future: Future) -> tuple[tuple, object]:
+    """
+    Wait for a rendering job, returns the job with its result or the error that prevented it
+    """
+    try:
+        return job, future.result()
+    except THUMBNAIL_ERRORS as error:
+        return job, error
+
+
+def render_jobs(jobs: list[tuple], workers: int) -> Iterator[tuple[tuple, object]]:
+    """
+    Render the thumbnails of every job, in a pool of worker processes when workers is set,
+    and yield the jobs in order with their result or the error that prevented it
+    """
+    if workers <= 0 or len(jobs) <= 1:
+        for job in jobs:
+            try:
+                yield job, render_file_thumbnails(*job)
+            except THUMBNAIL_ERRORS as error:
+                yield job, error
+        return
+
+    # Spawn instead of fork, as the parent process may run TensorFlow or Prefect threads
+    with ProcessPoolExecutor(
+        max_workers=min(workers, len(jobs)),
+        mp_context=multiprocessing.get_context("spawn"),
+    ) as executor:
+        pending = deque()
+        for job in jobs:
+            pending.append((job, executor.submit(render_file_thumbnails, *job)))
+            if len(pending) >= workers * THUMBNAIL_FILES_PER_WORKER:
+                yield get_job_result(*pending.popleft())
 
-            update_statement = (
-                files_table.update()
-                .where(files_table.c.id == row.id)
-                .values(thumbnail_filename=thumbnail_filename)
+        while pending:
+            yield get_job_result(*pending.popleft())
+
+
+def generate_missing_thumbnails(
+    db_engine: Engine, file_id: int | None = None, workers: int = 0
+):
+    """
+    Generate the thumbnails of all faces and files in the database, or only of the given file,
+    that do not have a thumbnail yet, decoding every source file once. Files are rendered in
+    a pool of worker processes when workers is set.
+    """
+    with db_engine.connect() as conn:
+        files = load_missing_thumbnails(conn, file_id)
+        jobs = [
+            (
+                os.environ["THUMBNAILS_PATH"],
+                thumbnail_file_id,
+                file["path"],
+                file["faces"],
+                file["file_thumbnail"],
             )
-            conn.execute(update_statement)
-            conn.commit()
+            for thumbnail_file_id, file in files.items()
+        ]
+
+        results = []
+        generated = 0
+        for job, result in render_jobs(jobs, workers):
+            if isinstance(result, Exception):
+                # Retried on the next run, as the thumbnails remain missing
+                print(f"Failed to create thumbnails of {job[2]}: {result}")
+                continue
+
+            generated += 1
+            results.append(result)
+            if len(results) >= THUMBNAIL_BATCH_SIZE:
+                store_thumbnail_filenames(conn, results)
+                results = []
+
+        store_thumbnail_filenames(conn, results)
+
+    if file_id is None:
+        print(f"Generated thumbnails of {generated} of {len(jobs)} files")
 
 
 @flow()
@@ -130,11 +265,14 @@ def generate_thumbnails():
     """
     Generate thumbnails for all faces and files in the database
     """
+    if THUMBNAIL_MODE == "lazy":
+        print("Thumbnails are rendered on request by the web interface, skipping")
+        return
+
     db_engine = create_engine("sqlite:///" + os.environ["DATABASE_PATH"])
 
     create_thumbnails_folder_if_needed(os.environ["THUMBNAILS_PATH"])
-    generate_face_thumbnails(db_engine)
-    generate_file_thumbnails(db_engine)
+    generate_missing_thumbnails(db_engine, workers=THUMBNAIL_WORKERS)
 
 
 if __name__ == "__main__":
@@ -2,11 +2,12 @@
 
 import os
 
-import faiss
 from dotenv import load_dotenv
 from prefect import flow
-from sqlalchemy import Engine, create_engine, insert
+from sqlalchemy import Engine, create_engine, inspect, text
+from sqlalchemy.dialects.sqlite import insert
 
+from ..utils.embeddings_index import create_index, write_index
 from ..utils.tables import meta
 from ..utils.tables import persons as persons_table
 
@@ -21,15 +22,38 @@ def create_tables(db_engine: Engine) -> None:
     """
     meta.create_all(db_engine)
 
+    # Nor are columns added to existing tables, e.g. files.subject_tags. SQLite can only
+    # add nullable columns, which all columns added to existing tables are.
+    inspector = inspect(db_engine)
+    with db_engine.begin() as conn:
+        for table in meta.sorted_tables:
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                column_type = column.type.compile(db_engine.dialect)
+                conn.execute(
+                    text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}")
+                )
+
+    # Indexes added to existing tables are not created by create_all
+    for table in meta.sorted_tables:
+        for index in table.indexes:
+            index.create(db_engine, checkfirst=True)
+
 
 def create_embeddings_index(dimension: int) -> None:
     """
     Create a vector embeddings index based on Faiss and store it to disk
     """
-    # Create a new index
-    index = faiss.IndexFlatL2(dimension)
-    index_with_ids = faiss.IndexIDMap(index)
-    faiss.write_index(index_with_ids, os.environ["EMBEDDINGS_INDEX_PATH"])
+    # Keep the existing index, so incremental runs don't lose earlier embeddings
+    if os.path.exists(os.environ["EMBEDDINGS_INDEX_PATH"]):
+        return
+
+    # Create a new index, which starts as an exact flat index until it's large enough
+    # to be promoted to the configured index type
+    index = create_index(dimension, "flat")
+    write_index(index, os.environ["EMBEDDINGS_INDEX_PATH"])
 
 
 def insert_initial_data(db_engine: Engine) -> None:
@@ -39,7 +63,11 @@ def insert_initial_data(db_engine: Engine) -> None:
     with db_engine.connect() as conn:
         # Insert 'Ignored' person which will be linked to all faces
         # we don't want to link to a specific person
-        query = insert(persons_table).values(id=0, name="Ignored")
+        query = (
+            insert(persons_table)
+            .values(id=0, name="Ignored")
+            .on_conflict_do_nothing(index_elements=["id"])
+        )
         conn.execute(query)
         conn.commit()
         conn.close()
@@ -6,17 +6,23 @@ from . import (
     initialize_database,
     parse_modified_files,
     generate_embeddings,
-    generate_thumbnails
+    generate_thumbnails,
+    streaming_pipeline
 )
 
 
 @flow(log_prints=True)
-def run_pipeline():
+def run_pipeline(verify: bool = False, streaming: bool = False):
     """
-    Run the file pipeline
+    Run the file pipeline, either stage by stage or with all stages streaming concurrently
     """
     initialize_database.initialize_database()
-    parse_modified_files.parse_modified_files()
+
+    if streaming:
+        streaming_pipeline.run_streaming_pipeline(verify)
+        return
+
+    parse_modified_files.parse_modified_files(verify)
     generate_embeddings.generate_embeddings()
     generate_thumbnails.generate_thumbnails()
 
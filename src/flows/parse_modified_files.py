@@ -1,124 +1,460 @@
 """Finds and parses all modified files within the library and stores their metadata"""
 
-import hashlib
+import argparse
 import os
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 from dotenv import load_dotenv
 from prefect import flow, task
-from sqlalchemy import Engine, create_engine, insert
+from sqlalchemy import Engine, case, create_engine, null, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from exiftool import ExifToolHelper
 
+from ..utils.exif import read_subject_tags
+from ..utils.hashing import get_hash_workers, get_stat_signature, hash_files
+from ..utils.tables import directories as directories_table
 from ..utils.tables import files as files_table
+from ..utils.tables import manifest as manifest_table
+from .collect_garbage import collect_garbage
 
 load_dotenv()  # Inject environment variables from .env during development
 
 SUPPORTED_FILE_EXTENSIONS = [".jpg", ".jpeg", ".png"]
+# Number of scanned files written to the database per transaction
+METADATA_BATCH_SIZE = 500
 
 
-@task()
-def list_all_supported_filepaths(
-    library_path: str, supported_extensions: list[str]
-) -> list[str]:
+def walk_supported_filepaths(
+    library_path: str,
+    supported_extensions: list[str],
+    directory_cache: dict[str, tuple[int, list[str]]],
+    full_scan: bool = False,
+) -> Iterator[str]:
     """
-    List all files of a supported extension by walking
-    through all subdirectories in the library path and
-    return their full path
+    Lazily yield the full path of all files of a supported extension in directories
+    whose entries changed since the previous scan. Directories with an unchanged
+    modification time are not listed again, only their cached subdirectories are
+    visited. The directory cache is updated in place once the walk is completed.
     """
-    paths = []
-    # Walk through all files in all subdirectories
-    for root, dirs, files in os.walk(library_path):
-        # Exclude hidden files and directories
-        files = [f for f in files if not f[0] == "."]
-        dirs[:] = [d for d in dirs if not d[0] == "."]
+    visited = {}
+    pending = [library_path]
+
+    while pending:
+        directory = pending.pop()
+        try:
+            # Read the mtime before listing, so changes during the listing are seen next time
+            mtime_ns = os.stat(directory).st_mtime_ns
+        except FileNotFoundError:
+            continue  # Removed, so its files are taken for deleted
+        except OSError as error:
+            print(f"Failed to stat {directory}: {error}")
+            # Keep the previous listing, so e.g. a transient NAS error doesn't delete its files
+            cached = directory_cache.get(directory)
+            if cached is not None:
+                visited[directory] = cached
+                pending.extend(cached[1])
+            continue
+
+        cached = directory_cache.get(directory)
+        if not full_scan and cached is not None and cached[0] == mtime_ns:
+            visited[directory] = cached
+            pending.extend(cached[1])
+            continue
+
+        subdirectories = []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    # Exclude hidden files and directories
+                    if entry.name.startswith("."):
+                        continue
 
-        for file in files:
-            path = os.path.join(root, file)
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirectories.append(entry.path)
+                    # Only yield files with supported file extensions
+                    elif (
+                        os.path.splitext(entry.name)[1].lower() in supported_extensions
+                        and entry.is_file()
+                    ):
+                        yield entry.path
+        except OSError as error:
+            print(f"Failed to list {directory}: {error}")
+            # Keep the previous listing, so its files are not taken for deleted
+            if cached is not None:
+                visited[directory] = cached
+                pending.extend(cached[1])
+            continue
 
-            # Only add files with supported file extensions
-            if os.path.splitext(file)[1].lower() in supported_extensions:
-                paths.append(path)
-    return paths
+        visited[directory] = (mtime_ns, subdirectories)
+        pending.extend(subdirectories)
+
+    # Directories that were not visited anymore have been removed
+    directory_cache.clear()
+    directory_cache.update(visited)
+
+
+@task()
+def load_directory_cache(db_engine: Engine) -> dict[str, tuple[int, list[str]]]:
+    """
+    Load the modification time and subdirectories of all directories listed in a previous run
+    """
+    with db_engine.connect() as conn:
+        statement = select(directories_table)
+        return {
+            row.path: (row.mtime_ns, row.subdirectories)
+            for row in conn.execute(statement)
+        }
 
 
 @task()
-def calculate_file_hash(filepath: str) -> str:
+def store_directory_cache(
+    db_engine: Engine,
+    previous_cache: dict[str, tuple[int, list[str]]],
+    directory_cache: dict[str, tuple[int, list[str]]],
+):
     """
-    Calculate the SHA-256 hash of a file block by block to support large files
+    Store the changed entries of the directory cache in a single transaction
     """
-    block_size = 65536  # The size of each read from the file
+    removed = [path for path in previous_cache if path not in directory_cache]
+    changed = [
+        {"path": path, "mtime_ns": mtime_ns, "subdirectories": subdirectories}
+        for path, (mtime_ns, subdirectories) in directory_cache.items()
+        if previous_cache.get(path) != (mtime_ns, subdirectories)
+    ]
+
+    statement = sqlite_insert(directories_table)
+    statement = statement.on_conflict_do_update(
+        index_elements=["path"],
+        set_={
+            "mtime_ns": statement.excluded.mtime_ns,
+            "subdirectories": statement.excluded.subdirectories,
+        },
+    )
+
+    with db_engine.begin() as conn:
+        if changed:
+            conn.execute(statement, changed)
+        if removed:
+            conn.execute(
+                directories_table.delete().where(directories_table.c.path.in_(removed))
+            )
+
 
-    file_hash = hashlib.sha256()  # Create the hash object
-    with open(filepath, "rb") as f:
-        fb = f.read(block_size)
-        while len(fb) > 0:
-            file_hash.update(fb)  # Update the hash
-            fb = f.read(block_size)  # Read the next block from the file
+def find_deleted_files(
+    manifest: dict[str, tuple[int, int, int, int]],
+    listed: set[str],
+    previous_cache: dict[str, tuple[int, list[str]]],
+    directory_cache: dict[str, tuple[int, list[str]]],
+    full_scan: bool = False,
+) -> list[str]:
+    """
+    Find the known files that were not listed anymore in the directories that were listed
+    again or have been removed, as only those can have lost files since the previous scan
+    """
+    changed_directories = {
+        path
+        for path in previous_cache.keys() | directory_cache.keys()
+        if full_scan or previous_cache.get(path) != directory_cache.get(path)
+    }
+    if not changed_directories:
+        return []
 
-    return file_hash.hexdigest()  # Return the hexadecimal digest of the hash
+    return [
+        filepath
+        for filepath in manifest
+        if filepath not in listed and os.path.dirname(filepath) in changed_directories
+    ]
 
 
 @task()
-def get_file_exif_tags(filepath: str) -> str:
+def load_manifest(
+    db_engine: Engine, filepaths: list[str] | None = None
+) -> dict[str, tuple[int, int, int, int]]:
     """
-    Read XMP Subject tag from the file to see if it already contains person tags
+    Load the stat signatures of all files, or only the given files,
+    that were hashed in a previous run
     """
-    with ExifToolHelper() as et:
-        for d in et.get_tags(filepath, tags=["Subject"]):
-            for k, v in d.items():
-                print(f"Dict: {k} = {v}")
+    statement = select(
+        manifest_table.c.path,
+        manifest_table.c.size,
+        manifest_table.c.mtime_ns,
+        manifest_table.c.inode,
+        manifest_table.c.device,
+    )
+    if filepaths is None:
+        statements = [statement]
+    else:
+        # Stay well below the maximum number of SQLite query parameters
+        statements = [
+            statement.where(manifest_table.c.path.in_(filepaths[i : i + 500]))
+            for i in range(0, len(filepaths), 500)
+        ]
+
+    with db_engine.connect() as conn:
+        return {
+            row.path: (row.size, row.mtime_ns, row.inode, row.device)
+            for statement in statements
+            for row in conn.execute(statement)
+        }
 
 
 @task()
-def store_metadata(
-    db_engine: Engine, filepath: str, file_hash: str, last_updated: float
-) -> str:
+def load_existing_hashes(
+    db_engine: Engine, filepaths: list[str] | None = None
+) -> dict[str, str]:
     """
-    Store the file metadata in the database
+    Load the hash of every file, or only the given files, already in the database
+    in a single query per chunk of files
     """
+    statement = select(files_table.c.path, files_table.c.hash)
+    if filepaths is None:
+        statements = [statement]
+    else:
+        # Stay well below the maximum number of SQLite query parameters
+        statements = [
+            statement.where(files_table.c.path.in_(filepaths[i : i + 500]))
+            for i in range(0, len(filepaths), 500)
+        ]
+
     with db_engine.connect() as conn:
-        # Check if the file already exists in the database
-        file_exists = conn.execute(
-            files_table.select().where(files_table.c.path == filepath)
-        ).first()
+        return {
+            row.path: row.hash
+            for statement in statements
+            for row in conn.execute(statement)
+        }
 
-        if file_exists is None:
-            conn.execute(
-                insert(files_table).values(
-                    path=filepath, hash=file_hash, last_updated=last_updated
+
+class MetadataWriter:
+    """
+    Collects scanned file records and writes them to the database in chunked
+    transactions, using upserts so no per-file lookups are needed
+    """
+
+    def __init__(
+        self,
+        db_engine: Engine,
+        existing_hashes: dict[str, str],
+        batch_size: int = METADATA_BATCH_SIZE,
+    ):
+        self.db_engine = db_engine
+        self.existing_hashes = existing_hashes
+        self.batch_size = batch_size
+        self.files = []
+        self.manifests = []
+        self.new = 0
+        self.modified = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
+
+    def add(
+        self,
+        filepath: str,
+        file_hash: str,
+        last_updated: datetime,
+        subject_tags: list[str],
+        signature: tuple[int, int, int, int],
+    ):
+        """
+        Add a scanned file record, writing the batch once it is full
+        """
+        previous_hash = self.existing_hashes.get(filepath)
+        if previous_hash is None:
+            self.new += 1
+        elif previous_hash != file_hash:
+            self.modified += 1
+        self.existing_hashes[filepath] = file_hash
+
+        self.files.append(
+            {
+                "path": filepath,
+                "hash": file_hash,
+                "last_updated": last_updated,
+                "subject_tags": subject_tags,
+            }
+        )
+        size, mtime_ns, inode, device = signature
+        self.manifests.append(
+            {
+                "path": filepath,
+                "size": size,
+                "mtime_ns": mtime_ns,
+                "inode": inode,
+                "device": device,
+            }
+        )
+
+        if len(self.files) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write all collected records in a single transaction
+        """
+        if not self.files:
+            return
+
+        files_statement = sqlite_insert(files_table)
+        files_statement = files_statement.on_conflict_do_update(
+            index_elements=["path"],
+            set_={
+                "hash": files_statement.excluded.hash,
+                "last_updated": files_statement.excluded.last_updated,
+                "subject_tags": files_statement.excluded.subject_tags,
+                # Modified content has to go through face detection again
+                "contains_face": case(
+                    (files_table.c.hash != files_statement.excluded.hash, null()),
+                    else_=files_table.c.contains_face,
+                ),
+            },
+        )
+
+        manifest_statement = sqlite_insert(manifest_table)
+        manifest_statement = manifest_statement.on_conflict_do_update(
+            index_elements=["path"],
+            set_={
+                "size": manifest_statement.excluded.size,
+                "mtime_ns": manifest_statement.excluded.mtime_ns,
+                "inode": manifest_statement.excluded.inode,
+                "device": manifest_statement.excluded.device,
+            },
+        )
+
+        with self.db_engine.begin() as conn:
+            conn.execute(files_statement, self.files)
+            conn.execute(manifest_statement, self.manifests)
+
+        self.files = []
+        self.manifests = []
+
+
+def store_file_chunk(
+    et: ExifToolHelper,
+    writer: MetadataWriter,
+    signatures: dict[str, tuple[int, int, int, int]],
+    workers: int,
+    executor: ThreadPoolExecutor | None = None,
+    report: bool = True,
+) -> set[str]:
+    """
+    Hash, read the tags of and store a chunk of new or modified files through an already
+    running ExifTool process and metadata writer, so callers storing many chunks start
+    them only once. Returns the paths of the files that were stored.
+    """
+    file_hashes = hash_files(list(signatures), workers, executor, report)
+
+    # Read the XMP Subject to see if the files already contain person tags
+    exif_tags = read_subject_tags(et, list(file_hashes))
+
+    for filepath, file_hash in file_hashes.items():
+        writer.add(
+            filepath,
+            file_hash,
+            datetime.fromtimestamp(signatures[filepath][1] / 1e9),
+            exif_tags.get(filepath, []),
+            signatures[filepath],
+        )
+    # Store the chunk right away, so its hashing is never lost
+    writer.flush()
+
+    return set(file_hashes)
+
+
+def store_modified_files(
+    db_engine: Engine, signatures: dict[str, tuple[int, int, int, int]]
+) -> set[str]:
+    """
+    Hash, read the tags of and store the metadata of new or modified files one chunk
+    at a time, so an interrupted scan keeps the chunks stored so far.
+    Returns the paths of files that could not be hashed.
+    """
+    filepaths = list(signatures)
+    workers = get_hash_workers(os.environ["LIBRARY_PATH"])
+    existing_hashes = load_existing_hashes(db_engine, filepaths)
+
+    hashed = set()
+    # A single ExifTool process is kept open for all chunks
+    with ExifToolHelper() as et, MetadataWriter(db_engine, existing_hashes) as writer:
+        for start in range(0, len(filepaths), METADATA_BATCH_SIZE):
+            chunk = filepaths[start : start + METADATA_BATCH_SIZE]
+            hashed.update(
+                store_file_chunk(
+                    et, writer, {filepath: signatures[filepath] for filepath in chunk}, workers
                 )
             )
-            conn.commit()
-        elif file_exists.hash != file_hash:
-            conn.execute(
-                files_table.update()
-                .where(files_table.c.path == filepath)
-                .values(hash=file_hash, last_updated=last_updated)
-            )
-            conn.commit()
+
+    print(f"Stored {writer.new} new and {writer.modified} modified files")
+
+    return signatures.keys() - hashed
 
 
 @flow(log_prints=True)
-def parse_modified_files():
+def parse_modified_files(verify: bool = False):
     """
-    Find, parse and inject all modified files paths of all new or modified files within the library
+    Find, parse and inject all modified files paths of all new or modified files within the library.
+    Directories without added or removed entries and files whose stat signature did not change
+    since the previous run are skipped, unless verify is set which forces a full re-hash of every file.
     """
-    filepaths = list_all_supported_filepaths(
-        os.environ["LIBRARY_PATH"], SUPPORTED_FILE_EXTENSIONS
+    db_engine = create_engine("sqlite:///" + os.environ["DATABASE_PATH"])
+    manifest = load_manifest(db_engine)
+    previous_directory_cache = load_directory_cache(db_engine)
+    directory_cache = dict(previous_directory_cache)
+
+    # Size, mtime, inode and device all unchanged means the file is unchanged
+    listed = set()
+    signatures = {}
+    for filepath in walk_supported_filepaths(
+        os.environ["LIBRARY_PATH"],
+        SUPPORTED_FILE_EXTENSIONS,
+        directory_cache,
+        full_scan=verify,
+    ):
+        listed.add(filepath)
+        try:
+            signature = get_stat_signature(filepath)
+        except OSError:
+            continue
+        if verify or manifest.get(filepath) != signature:
+            signatures[filepath] = signature
+
+    print(
+        f"Skipped {len(listed) - len(signatures)} of {len(listed)} files in changed directories "
+        f"with an unchanged stat signature ({len(directory_cache)} directories in library)"
     )
 
-    db_engine = create_engine("sqlite:///" + os.environ["DATABASE_PATH"])
+    failed = store_modified_files(db_engine, signatures)
 
-    for filepath in filepaths:
-        exif_tags = get_file_exif_tags(filepath)
-        
-        store_metadata(
-            db_engine,
-            filepath,
-            calculate_file_hash(filepath),
-            datetime.fromtimestamp(os.path.getmtime(filepath)),
+    # Files that could not be hashed are retried next run by listing their directory again
+    for filepath in failed:
+        directory_cache.pop(os.path.dirname(filepath), None)
+
+    # Remove deleted files and the outdated faces of modified files, unless the library
+    # itself could not be listed, e.g. because the drive holding it is not mounted
+    if os.environ["LIBRARY_PATH"] in directory_cache:
+        collect_garbage(
+            find_deleted_files(
+                manifest, listed, previous_directory_cache, directory_cache, full_scan=verify
+            )
         )
+    else:
+        print(f"Library {os.environ['LIBRARY_PATH']} could not be listed, skipping deletions")
+
+    # Only remember the directories once all their files are stored
+    store_directory_cache(db_engine, previous_directory_cache, directory_cache)
 
 
 if __name__ == "__main__":
-    parse_modified_files()
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="Re-hash every file, even when its stat signature did not change",
+    )
+    args = parser.parse_args()
+
+    parse_modified_files(verify=args.verify)
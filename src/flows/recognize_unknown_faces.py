@@ -1,16 +1,30 @@
 """Recognize unknown faces based on the embeddings in the Faiss index"""
 
 import os
-import uuid
-from collections import Counter
 
 import faiss
 import numpy as np
 from dotenv import load_dotenv
 from prefect import flow
-from sqlalchemy import create_engine, select
-
-from ..utils.tables import faces as faces_table, clusters as clusters_table
+from sqlalchemy import bindparam, create_engine, select
+
+from ..utils.embedding_codec import EMBEDDING_METRIC
+from ..utils.embedding_store import EmbeddingStore, get_embeddings, is_stored
+from ..utils.embeddings_index import read_index, search_index, write_index
+from ..utils.face_clustering import find_neighbor_edges, update_clusters
+from ..utils.person_lookup import NO_FACE, UNLABELED, get_face_persons, load_face_persons
+from ..utils.persons_index import build_persons_index, lock_persons_index, search_persons
+from ..utils.processing_state import (
+    INDEX_GENERATION,
+    RECOGNITION_INDEX_GENERATION,
+    RECOGNITION_LABEL_HIGH_WATER_MARK,
+    get_state,
+    set_state,
+)
+from ..utils.tables import face_neighbors as face_neighbors_table
+from ..utils.tables import faces as faces_table
+from ..utils.tables import label_changes as label_changes_table
+from .initialize_database import EMBEDDING_DIMENSION
 
 load_dotenv()  # Inject environment variables from .env during development
 
@@ -18,111 +32,172 @@ load_dotenv()  # Inject environment variables from .env during development
 K_NEAREST_NEIGHBORS = 5
 # Percentage of the minimum distance to consider faces as similar
 SIMILAR_FACES_RELATIVE_TO_MIN_DISTANCE = 0.10
-# Maximum number of similar faces to consider, higher numbers leads to more db queries
+# Maximum number of similar faces to consider
 MAX_SIMILAR_FACES = 3
+# Number of unknown faces searched in the Faiss index at once
+RECOGNITION_BATCH_SIZE = 4096
+# Distances are squared L2 distances, which lie between 0 and 4 for normalized embeddings of the cosine metric
 # Threshold of the maximum distance value for clustering unknown faces together as being the likely the same person, a higher value will result is more false positives, while a lower value clusters less unknown faces
-ASSUME_SAME_PERSON_THRESHOLD = 10
+ASSUME_SAME_PERSON_THRESHOLD = 10 if EMBEDDING_METRIC == "l2" else 0.64
+# Number of face ids per IN clause when reading or replacing stored neighbors
+NEIGHBORS_BATCH_SIZE = 500
+# Maximum distance to the closest prototype of a known person to suggest that person directly,
+# faces farther from every person fall back to voting over their nearest neighbors
+PERSON_MATCH_THRESHOLD = 10 if EMBEDDING_METRIC == "l2" else 0.64
 
 
 def find_nearest_neighbors(
-    embedding: list[float], index: faiss.Index
-) -> tuple[list[float], list[int]]:
+    face_ids: np.ndarray, distances: np.ndarray, indices: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
     """
-    Find the k nearest neighbors of the given embedding in the Faiss index
+    Filter the k nearest neighbors a batch of faces got from the Faiss index, returns (n, MAX_SIMILAR_FACES)
+    matrices of distances and indices, where filtered out neighbors have distance inf and index -1
     """
-    # Search for the nearest neighbor in the Faiss index
-    distances, indices = index.search(np.array([embedding]), K_NEAREST_NEIGHBORS)
-
-    # Remove indices with distance 0, which is the searched face itself
-    distance_zero = np.where(distances == 0)
-    indices = np.delete(indices, distance_zero)
-    distances = np.delete(distances, distance_zero)
+    # Remove the searched face itself, which compressed indexes don't return at distance 0,
+    # and missing results when the index holds less than k faces
+    relevant = (indices >= 0) & (indices != face_ids[:, None])
 
     # Remove indices that have a distance that's more that xx% higher than the
     # minimum distance as they are probably not relevant
-    distance_threshold = np.where(
-        distances > distances[0] * (1 + SIMILAR_FACES_RELATIVE_TO_MIN_DISTANCE)
-    )
-    indices = np.delete(indices, distance_threshold)
-    distances = np.delete(distances, distance_threshold)
+    min_distances = np.where(relevant, distances, np.inf).min(axis=1, keepdims=True)
+    relevant &= distances <= min_distances * (1 + SIMILAR_FACES_RELATIVE_TO_MIN_DISTANCE)
 
     # Limit the number of similar faces to consider
-    indices = indices[:MAX_SIMILAR_FACES]
-    distances = distances[:MAX_SIMILAR_FACES]
+    relevant &= np.cumsum(relevant, axis=1) <= MAX_SIMILAR_FACES
+
+    # Move the relevant neighbors to the front of every row, keeping their order
+    order = np.argsort(~relevant, axis=1, kind="stable")[:, :MAX_SIMILAR_FACES]
+    distances = np.take_along_axis(np.where(relevant, distances, np.inf), order, axis=1)
+    indices = np.take_along_axis(np.where(relevant, indices, -1), order, axis=1)
 
     return distances, indices
 
 
-def find_best_matching_known_person(ids: list, conn) -> int | None:
+def find_best_matching_known_persons(
+    indices: np.ndarray, face_persons: np.ndarray
+) -> np.ndarray:
     """
-    Find the best matching known person in the db
-    Matching a person that's already confirmed is the best guess we can make
+    Find the best matching known person for a batch of faces, given the (n, m) indices of their
+    nearest neighbors, returns the best matching person id per face or -1 when there is none.
+    Matching a person that's already confirmed is the best guess we can make.
     """
-    # Get person_id for all close faces
-    statement = select(faces_table.c.person_id).where(
-        faces_table.c.id.in_(ids.tolist())
-    )
+    # Get person_id for all close faces, neighbors that don't exist are ignored
+    persons = get_face_persons(face_persons, indices)
+    found = persons != NO_FACE
 
-    found_persons = []
+    # Count for every neighbor how many neighbors of the same face have the same person
+    same_person = (persons[:, :, None] == persons[:, None, :]) & found[:, None, :]
+    duplicate_counts = np.where(found, same_person.sum(axis=2), 0)
 
-    for row_face in conn.execute(statement):
-        found_persons.append(row_face.person_id)
-
-    # Count the duplicate values
-    duplicate_counts = Counter(found_persons)
-
-    # Sort the duplicate counts in descending order
-    sorted_counts = sorted(duplicate_counts.items(), key=lambda x: x[1], reverse=True)
-
-    # Best matching person is the one with the highest count
-    best_match_id, best_match_count = sorted_counts[0]
+    # Best matching person is the one with the highest count, the closest one on a tie
+    best = duplicate_counts.argmax(axis=1)[:, None]
+    best_match_ids = np.take_along_axis(persons, best, axis=1)[:, 0]
+    best_match_counts = np.take_along_axis(duplicate_counts, best, axis=1)[:, 0]
 
     # Only suggest when at least half of the found matches are the same person
-    if best_match_count >= int(len(found_persons) / 2) and best_match_id is not None:
-        return best_match_id
-
-    return None
+    found_counts = found.sum(axis=1)
+    suggest = (
+        (found_counts > 0)
+        & (best_match_ids != UNLABELED)
+        & (best_match_counts >= found_counts // 2)
+    )
+    return np.where(suggest, best_match_ids, -1)
 
 
-def cluster_unknown_persons(
-    face_id: int, indices: list[int], distances: list[float], conn
-):
+def load_persons_index(conn, store: EmbeddingStore) -> faiss.Index:
     """
-    If we find a face to match closely with some other unknown faces, we assume it's the same person
-    and therefor cluster it together with other unknown faces.
+    Load the index of person prototypes, building it from all labeled faces when it doesn't exist
     """
-    irrelevant_neighbors = np.where(distances > ASSUME_SAME_PERSON_THRESHOLD)
-    indices = np.delete(indices, irrelevant_neighbors)
-    similar_faces = [face_id] + indices.tolist()
-
-    if len(indices) <= 0:
-        return
+    path = os.environ["PERSONS_INDEX_PATH"]
+    with lock_persons_index(path):
+        if os.path.exists(path):
+            return read_index(path)
+
+        index = build_persons_index(conn, store, EMBEDDING_DIMENSION)
+        write_index(index, path)
+        print(f"Built persons index holding {index.ntotal} prototypes")
+        return index
+
+
+def find_faces_to_evaluate(
+    conn,
+    index: faiss.Index,
+    store_rows: np.ndarray,
+    embeddings: np.ndarray,
+    unknown_ids: np.ndarray,
+    unevaluated_ids: np.ndarray,
+) -> tuple[np.ndarray, int]:
+    """
+    Select the unknown faces that were never evaluated, or whose neighborhood changed because
+    faces near them got labeled since the last run. Returns the faces and the last label change.
+    """
+    label_high_water_mark = get_state(conn, RECOGNITION_LABEL_HIGH_WATER_MARK)
 
-    print(
-        f"Try to cluster unknown person {face_id} and it's probably same face neighbors: {indices}"
+    statement = select(label_changes_table.c.id, label_changes_table.c.face_id).where(
+        label_changes_table.c.id > label_high_water_mark
     )
-
-    # Look for the face itself or it's close neighbors in the clusters table
-    statement_face = select(clusters_table.c.cluster_id).where(
-        clusters_table.c.face_id.in_(similar_faces)
+    label_changes = conn.execute(statement).all()
+    labeled_ids = np.unique(np.array([row.face_id for row in label_changes], dtype=np.int64))
+    if label_changes:
+        label_high_water_mark = max(row.id for row in label_changes)
+
+    # A rebuilt index gives different search results, so all faces are evaluated again
+    if get_state(conn, RECOGNITION_INDEX_GENERATION, -1) != get_state(conn, INDEX_GENERATION):
+        print(f"Evaluating all {len(unknown_ids)} unknown faces in a rebuilt index")
+        return unknown_ids, label_high_water_mark
+
+    # Faces that had a newly labeled face among their neighbors when they were evaluated
+    affected_ids = [np.empty(0, dtype=np.int64)]
+    for start in range(0, len(labeled_ids), NEIGHBORS_BATCH_SIZE):
+        statement = select(face_neighbors_table.c.face_id).where(
+            face_neighbors_table.c.neighbor_id.in_(
+                labeled_ids[start : start + NEIGHBORS_BATCH_SIZE].tolist()
+            )
+        )
+        affected_ids.append(np.array(conn.execute(statement).scalars().all(), dtype=np.int64))
+
+    # And the faces close to a newly labeled face, which may now match its person's prototypes
+    labeled_ids = labeled_ids[is_stored(store_rows, labeled_ids)]
+    for start in range(0, len(labeled_ids), RECOGNITION_BATCH_SIZE):
+        batch_ids = labeled_ids[start : start + RECOGNITION_BATCH_SIZE]
+        _, indices = search_index(
+            index, get_embeddings(store_rows, embeddings, batch_ids), K_NEAREST_NEIGHBORS
+        )
+        affected_ids.append(indices[indices >= 0])
+
+    evaluate = np.isin(unknown_ids, unevaluated_ids) | np.isin(
+        unknown_ids, np.concatenate(affected_ids)
     )
+    print(
+        f"Evaluating {evaluate.sum()} of {len(unknown_ids)} unknown faces after "
+        f"{len(label_changes)} label changes"
+    )
+    return unknown_ids[evaluate], label_high_water_mark
 
-    cluster = conn.execute(statement_face).fetchone()
-
-    cluster_id = None
 
-    # Create a new cluster if neither the face_id nor it's close neighbors are in any existing cluster yet
-    if cluster and cluster.cluster_id:
-        cluster_id = cluster.cluster_id
-    else:
-        cluster_id = uuid.uuid4()
+def store_face_neighbors(conn, face_ids: np.ndarray, indices: np.ndarray):
+    """
+    Replace the stored nearest neighbors of the given faces by the raw search results
+    """
+    for start in range(0, len(face_ids), NEIGHBORS_BATCH_SIZE):
+        conn.execute(
+            face_neighbors_table.delete().where(
+                face_neighbors_table.c.face_id.in_(
+                    face_ids[start : start + NEIGHBORS_BATCH_SIZE].tolist()
+                )
+            )
+        )
 
-    values = []
-    for face in similar_faces:
-        values.append({"face_id": face, "cluster_id": cluster_id})
-    insert_statement = clusters_table.insert().values(values)
-    conn.execute(insert_statement)
-    conn.commit()
+    sources = np.broadcast_to(face_ids[:, None], indices.shape)
+    relevant = (indices >= 0) & (indices != sources)
+    values = [
+        {"face_id": face_id, "neighbor_id": neighbor_id}
+        for face_id, neighbor_id in set(
+            zip(sources[relevant].tolist(), indices[relevant].tolist())
+        )
+    ]
+    if values:
+        conn.execute(face_neighbors_table.insert(), values)
 
 
 @flow()
@@ -131,37 +206,111 @@ def recognize_unknown_faces():
     Recognize unknown faces based on the embeddings in the Faiss index
     """
     db_engine = create_engine("sqlite:///" + os.environ["DATABASE_PATH"])
-    index = faiss.read_index(os.environ["EMBEDDINGS_INDEX_PATH"])
+    index = read_index(os.environ["EMBEDDINGS_INDEX_PATH"])
+
+    # Memory-map all embeddings at once instead of decoding them row by row
+    store = EmbeddingStore(os.environ["EMBEDDINGS_STORE_PATH"], EMBEDDING_DIMENSION)
+    store_rows, embeddings = store.load_rows()
 
     with db_engine.connect() as conn:
-        statement = select(faces_table).where(faces_table.c.person_id.is_(None))
-        for row in conn.execute(statement):
-            # Load the face embedding from the database
-            embedding = np.frombuffer(row.embedding, dtype=np.float32)
+        # Person of every face, to vote on the persons of the neighbors without querying per face
+        face_persons = load_face_persons(conn)
+        persons_index = load_persons_index(conn, store)
+
+        index_generation = get_state(conn, INDEX_GENERATION)
+
+        statement = select(faces_table.c.id, faces_table.c.evaluated).where(
+            faces_table.c.person_id.is_(None)
+        )
+        unknown_faces = conn.execute(statement).all()
+        unknown_ids = np.array([row.id for row in unknown_faces], dtype=np.int64)
+        unevaluated_ids = np.array(
+            [row.id for row in unknown_faces if not row.evaluated], dtype=np.int64
+        )
+        # Faces stored after the embedding store was loaded are evaluated on the next run
+        unknown_ids = unknown_ids[is_stored(store_rows, unknown_ids)]
+
+        evaluate_ids, label_high_water_mark = find_faces_to_evaluate(
+            conn, index, store_rows, embeddings, unknown_ids, unevaluated_ids
+        )
+
+        edge_sources = [np.empty(0, dtype=np.int64)]
+        edge_targets = [np.empty(0, dtype=np.int64)]
+
+        for start in range(0, len(evaluate_ids), RECOGNITION_BATCH_SIZE):
+            batch_ids = evaluate_ids[start : start + RECOGNITION_BATCH_SIZE]
+            batch_embeddings = get_embeddings(store_rows, embeddings, batch_ids)
+
+            # Search for the nearest neighbors of the whole batch at once
+            search_distances, search_indices = search_index(
+                index, batch_embeddings, K_NEAREST_NEIGHBORS
+            )
+            _, batch_indices = find_nearest_neighbors(
+                batch_ids, search_distances, search_indices
+            )
 
-            distances, indices = find_nearest_neighbors(embedding, index)
+            # Match against the prototypes of the known persons first, one small search per batch
+            person_distances, person_ids = search_persons(persons_index, batch_embeddings)
+            best_match_ids = np.where(
+                person_distances <= PERSON_MATCH_THRESHOLD,
+                person_ids,
+                find_best_matching_known_persons(batch_indices, face_persons),
+            )
 
+            # Save the best matching persons in the database, clearing suggestions
+            # of re-evaluated faces that no longer match a person
+            suggestions = [
+                {"face_id": face_id, "person_id": person_id if person_id >= 0 else None}
+                for face_id, person_id in zip(batch_ids.tolist(), best_match_ids.tolist())
+            ]
             print(
-                f"Nearest Neighbors of {row.id} are {indices} with distances {distances}"
+                f"Suggesting a matching person for {(best_match_ids >= 0).sum()} faces"
             )
 
-            best_match_id = find_best_matching_known_person(indices, conn)
-
-            # Save the best matching person in the database
-            if best_match_id is not None:
-                print(f"Best matching person: {best_match_id}")
-
-                # Update the face with the best matching person
-                update_statement = (
-                    faces_table.update()
-                    .where(faces_table.c.id == row.id)
-                    .values(person_id_suggested=best_match_id)
-                )
-                conn.execute(update_statement)
-                conn.commit()
-            else:
-                # Try to cluster with other unknown persons
-                cluster_unknown_persons(row.id, indices, distances, conn)
+            # Update the faces with the best matching person
+            update_statement = (
+                faces_table.update()
+                .where(faces_table.c.id == bindparam("face_id"))
+                .values(person_id_suggested=bindparam("person_id"), evaluated=True)
+            )
+            conn.execute(update_statement, suggestions)
+
+            # Remember the neighbors, to find the faces affected by future labels
+            store_face_neighbors(conn, batch_ids, search_indices)
+            conn.commit()
+
+            # Collect the edges between close unknown faces to cluster them all at once
+            sources, targets = find_neighbor_edges(
+                batch_ids,
+                search_distances,
+                search_indices,
+                face_persons,
+                ASSUME_SAME_PERSON_THRESHOLD,
+            )
+            edge_sources.append(sources)
+            edge_targets.append(targets)
+
+        # Clusters only change with new edges or when clustered faces got labeled
+        if len(evaluate_ids) > 0 or label_high_water_mark != get_state(
+            conn, RECOGNITION_LABEL_HIGH_WATER_MARK
+        ):
+            clusters = update_clusters(
+                conn,
+                unknown_ids,
+                np.concatenate(edge_sources),
+                np.concatenate(edge_targets),
+            )
+            print(f"Found {clusters} clusters of likely the same unknown person")
+
+        # Only move the high-water mark once all evaluated faces are saved
+        set_state(conn, RECOGNITION_LABEL_HIGH_WATER_MARK, label_high_water_mark)
+        set_state(conn, RECOGNITION_INDEX_GENERATION, index_generation)
+        conn.execute(
+            label_changes_table.delete().where(
+                label_changes_table.c.id <= label_high_water_mark
+            )
+        )
+        conn.commit()
 
 
 if __name__ == "__main__":
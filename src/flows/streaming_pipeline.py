@@ -0,0 +1,300 @@
+"""Runs the pipeline stages concurrently, streaming files from one stage to the next"""
+
+import os
+import queue
+import threading
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+
+from dotenv import load_dotenv
+from exiftool import ExifToolHelper
+from prefect import flow
+from sqlalchemy import Engine, create_engine, select
+
+from ..utils.embeddings_checkpoint import Checkpointer, open_embeddings
+from ..utils.garbage import clear_outdated_files
+from ..utils.hashing import get_hash_workers, get_stat_signature
+from ..utils.tables import files as files_table
+from ..utils.thumbnail_cache import THUMBNAIL_MODE
+from .collect_garbage import collect_garbage
+from .generate_embeddings import embed_file, load_processed_hashes
+from .generate_thumbnails import (
+    create_thumbnails_folder_if_needed,
+    generate_missing_thumbnails,
+)
+from .initialize_database import EMBEDDING_DIMENSION
+from .parse_modified_files import (
+    SUPPORTED_FILE_EXTENSIONS,
+    MetadataWriter,
+    find_deleted_files,
+    load_directory_cache,
+    load_existing_hashes,
+    load_manifest,
+    store_directory_cache,
+    store_file_chunk,
+    walk_supported_filepaths,
+)
+
+load_dotenv()  # Inject environment variables from .env during development
+
+# Maximum number of items waiting between two stages, which bounds the memory usage
+STREAM_QUEUE_SIZE = 256
+# Number of files hashed and stored together by the hash stage
+STREAM_HASH_CHUNK_SIZE = 64
+# Seconds a stage waits for the SQLite write lock held by another stage
+STREAM_DATABASE_TIMEOUT = 60
+
+DONE = object()  # Marks the end of a stream
+
+
+class StageInput:
+    """
+    Iterates over the items a previous stage puts on a queue until it is done
+    """
+
+    def __init__(self, items: queue.Queue):
+        self.items = items
+        self.finished = False
+
+    def __iter__(self) -> Iterator:
+        while not self.finished:
+            item = self.items.get()
+            if item is DONE:
+                self.finished = True
+                return
+            yield item
+
+
+def run_stage(
+    name: str,
+    stage,
+    stage_input: StageInput | None,
+    output: queue.Queue | None,
+    errors: list,
+):
+    """
+    Run a stage on the items of its input and put its results on the output,
+    always marking the output as done so the next stages can finish as well
+    """
+    try:
+        # Stages without an output return None instead of yielding results
+        for result in stage(stage_input) or ():
+            output.put(result)
+    except Exception as error:  # pylint: disable=broad-exception-caught
+        errors.append((name, error))
+        # Keep consuming the input, so earlier stages don't block on a full queue
+        if stage_input is not None:
+            for _ in stage_input:
+                pass
+    finally:
+        if output is not None:
+            output.put(DONE)
+
+
+def chunked(items: Iterable, size: int) -> Iterator[list]:
+    """
+    Group the items of an iterable in lists of the given size
+    """
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def scan_stage(
+    manifest: dict, directory_cache: dict, listed: set[str], verify: bool
+) -> Iterator[tuple[str, tuple[int, int, int, int]]]:
+    """
+    Yield the path and stat signature of all new or modified files in the library,
+    collecting the paths of all listed files to find the deleted files afterwards
+    """
+    for filepath in walk_supported_filepaths(
+        os.environ["LIBRARY_PATH"],
+        SUPPORTED_FILE_EXTENSIONS,
+        directory_cache,
+        full_scan=verify,
+    ):
+        listed.add(filepath)
+        try:
+            signature = get_stat_signature(filepath)
+        except OSError:
+            continue
+        if verify or manifest.get(filepath) != signature:
+            yield filepath, signature
+
+
+def hash_stage(
+    db_engine: Engine, failed_directories: set[str], items: StageInput
+) -> Iterator[tuple[int, str, str]]:
+    """
+    Hash and store the scanned files in chunks and yield the files that need face detection
+    """
+    emitted = set()
+
+    def pending_files(paths: list[str] | None = None):
+        statement = select(
+            files_table.c.id, files_table.c.path, files_table.c.hash
+        ).where(files_table.c.contains_face.is_(None))
+        if paths is not None:
+            statement = statement.where(files_table.c.path.in_(paths))
+
+        with db_engine.connect() as conn:
+            for row in conn.execute(statement).all():
+                if row.id not in emitted:
+                    emitted.add(row.id)
+                    yield row.id, row.path, row.hash
+
+    workers = get_hash_workers(os.environ["LIBRARY_PATH"])
+    # The files to store aren't known up front, so the hashes of the whole library are
+    # loaded once instead of querying them for every chunk
+    existing_hashes = load_existing_hashes(db_engine)
+
+    # A single ExifTool process, hashing pool and writer are kept open for all chunks
+    with (
+        ExifToolHelper() as et,
+        ThreadPoolExecutor(max_workers=workers) as executor,
+        MetadataWriter(db_engine, existing_hashes) as writer,
+    ):
+        for chunk in chunked(items, STREAM_HASH_CHUNK_SIZE):
+            signatures = dict(chunk)
+            stored = store_file_chunk(
+                et, writer, signatures, workers, executor, report=False
+            )
+
+            # Files that could not be hashed are retried next run by listing their directory again
+            failed_directories.update(
+                os.path.dirname(filepath) for filepath in signatures.keys() - stored
+            )
+
+            yield from pending_files(list(signatures))
+
+    print(f"Stored {writer.new} new and {writer.modified} modified files")
+
+    # Also process files that are still pending from an earlier, interrupted run
+    yield from pending_files()
+
+
+def embed_stage(db_engine: Engine, items: StageInput) -> Iterator[int]:
+    """
+    Detect faces and generate embeddings of the stored files and yield their ids
+    """
+    with db_engine.connect() as conn:
+        index, store = open_embeddings(conn, EMBEDDING_DIMENSION)
+        checkpointer = Checkpointer(conn, index, store)
+        processed_hashes = load_processed_hashes(conn)
+
+        for file_id, path, file_hash in items:
+            # A modified file still holds the faces of its previous content
+            checkpointer.discard(*clear_outdated_files(conn, [file_id]))
+
+            # Removing faces at a checkpoint can replace the index
+            checkpointer.persons_changed(
+                embed_file(
+                    conn, checkpointer.index, store, file_id, path, file_hash, processed_hashes
+                )
+            )
+            # Make the faces visible to the thumbnail stage before passing the file on
+            conn.commit()
+            checkpointer.file_done()
+            yield file_id
+
+        # Store the remaining faces and index to disk
+        checkpointer.finish()
+
+
+def thumbnail_stage(db_engine: Engine, items: StageInput):
+    """
+    Generate the face and file thumbnails of the processed files
+    """
+    create_thumbnails_folder_if_needed(os.environ["THUMBNAILS_PATH"])
+
+    for file_id in items:
+        # Still drain the files in lazy mode, so the upstream stages are never blocked
+        if THUMBNAIL_MODE == "lazy":
+            continue
+
+        # Every file is decoded once for its face and file thumbnails
+        generate_missing_thumbnails(db_engine, file_id)
+
+
+@flow(log_prints=True)
+def run_streaming_pipeline(verify: bool = False):
+    """
+    Run the scan, hash, embed and thumbnail stages concurrently, connected by bounded queues,
+    so every stage starts working as soon as the previous stage produced its first item
+    """
+    db_engine = create_engine(
+        "sqlite:///" + os.environ["DATABASE_PATH"],
+        connect_args={"timeout": STREAM_DATABASE_TIMEOUT},
+    )
+    manifest = load_manifest(db_engine)
+    previous_directory_cache = load_directory_cache(db_engine)
+    directory_cache = dict(previous_directory_cache)
+    listed = set()
+
+    scanned = queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+    stored = queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+    embedded = queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+
+    errors = []
+    failed_directories = set()
+    stages = [
+        (
+            "scan",
+            lambda _: scan_stage(manifest, directory_cache, listed, verify),
+            None,
+            scanned,
+        ),
+        (
+            "hash",
+            lambda items: hash_stage(db_engine, failed_directories, items),
+            StageInput(scanned),
+            stored,
+        ),
+        (
+            "embed",
+            lambda items: embed_stage(db_engine, items),
+            StageInput(stored),
+            embedded,
+        ),
+        (
+            "thumbnail",
+            lambda items: thumbnail_stage(db_engine, items),
+            StageInput(embedded),
+            None,
+        ),
+    ]
+    threads = [
+        threading.Thread(
+            target=run_stage, args=(*stage, errors), name=f"{stage[0]}-stage"
+        )
+        for stage in stages
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        name, error = errors[0]
+        raise RuntimeError(f"Streaming pipeline failed in the {name} stage") from error
+
+    for directory in failed_directories:
+        directory_cache.pop(directory, None)
+
+    # Deleted files can only be removed once the embed stage released the index
+    if os.environ["LIBRARY_PATH"] in directory_cache:
+        collect_garbage(
+            find_deleted_files(
+                manifest, listed, previous_directory_cache, directory_cache, full_scan=verify
+            )
+        )
+    else:
+        print(f"Library {os.environ['LIBRARY_PATH']} could not be listed, skipping deletions")
+
+    # Only remember the directories once all their files are stored
+    store_directory_cache(db_engine, previous_directory_cache, directory_cache)
@@ -0,0 +1,187 @@
+"""Watches the library for changes and ingests them in near real-time"""
+
+import os
+import threading
+import time
+
+from dotenv import load_dotenv
+from prefect import flow
+from sqlalchemy import create_engine
+from watchdog.events import FileSystemEvent, FileSystemEventHandler
+from watchdog.observers import Observer
+from watchdog.observers.polling import PollingObserver
+
+from ..utils.hashing import get_stat_signature
+from . import generate_embeddings, generate_thumbnails
+from .collect_garbage import collect_garbage
+from .parse_modified_files import (
+    SUPPORTED_FILE_EXTENSIONS,
+    load_manifest,
+    store_modified_files,
+    walk_supported_filepaths,
+)
+
+load_dotenv()  # Inject environment variables from .env during development
+
+# Seconds without new events before a batch of changes is ingested
+WATCH_DEBOUNCE_SECONDS = 10
+# Maximum seconds a change waits while events keep coming in, e.g. during a large sync
+WATCH_MAX_DELAY_SECONDS = 300
+# Seconds between two scans of the library when falling back to polling
+WATCH_POLLING_INTERVAL_SECONDS = 60
+
+
+class ChangeCollector(FileSystemEventHandler):
+    """
+    Collects and coalesces file system events, so a burst of events results in
+    a single batch holding the latest state of every changed path
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.changed = set()
+        self.deleted = set()
+        self.first_event = None
+        self.last_event = None
+
+    def on_any_event(self, event: FileSystemEvent):
+        if event.event_type not in ("created", "modified", "moved", "deleted", "closed"):
+            return
+        # A directory is modified whenever an entry is created or deleted in it, which
+        # are events of their own, so only directories that were created or moved in
+        # have to be walked
+        if event.is_directory and event.event_type in ("modified", "closed"):
+            return
+
+        with self.lock:
+            if event.event_type in ("moved", "deleted"):
+                self.changed.discard(event.src_path)
+                self.deleted.add(event.src_path)
+            else:
+                self.changed.add(event.src_path)
+
+            if event.event_type == "moved":
+                self.deleted.discard(event.dest_path)
+                self.changed.add(event.dest_path)
+
+            now = time.monotonic()
+            self.first_event = self.first_event or now
+            self.last_event = now
+
+    def pop_batch(self) -> tuple[set[str], set[str]] | None:
+        """
+        Return all changed and deleted paths once the events have settled down
+        """
+        with self.lock:
+            if self.first_event is None:
+                return None
+
+            now = time.monotonic()
+            if (
+                now - self.last_event < WATCH_DEBOUNCE_SECONDS
+                and now - self.first_event < WATCH_MAX_DELAY_SECONDS
+            ):
+                return None
+
+            batch = (self.changed, self.deleted)
+            self.changed, self.deleted = set(), set()
+            self.first_event = self.last_event = None
+            return batch
+
+
+def expand_changed_paths(paths: set[str]) -> set[str]:
+    """
+    Replace directories that were created or moved into the library by the supported files within them
+    """
+    filepaths = set()
+    for path in paths:
+        # Exclude hidden files and directories, like the library walker does
+        relative_path = os.path.relpath(path, os.environ["LIBRARY_PATH"])
+        if any(part.startswith(".") for part in relative_path.split(os.sep)):
+            continue
+
+        if os.path.isdir(path):
+            filepaths.update(
+                walk_supported_filepaths(path, SUPPORTED_FILE_EXTENSIONS, {}, full_scan=True)
+            )
+        elif os.path.splitext(path)[1].lower() in SUPPORTED_FILE_EXTENSIONS:
+            filepaths.add(path)
+    return filepaths
+
+
+@flow(log_prints=True)
+def ingest_changes(changed: list[str], deleted: list[str]):
+    """
+    Ingest a batch of changed paths through the pipeline stages
+    """
+    db_engine = create_engine("sqlite:///" + os.environ["DATABASE_PATH"])
+
+    # Paths can be created again after their deletion event within the same batch
+    deleted = [path for path in deleted if not os.path.exists(path)]
+    if deleted:
+        print(f"Removing {len(deleted)} deleted paths")
+        collect_garbage(deleted)
+
+    filepaths = sorted(expand_changed_paths(set(changed)))
+    manifest = load_manifest(db_engine, filepaths)
+
+    # Skip events that didn't change the file, e.g. a metadata-only touch
+    signatures = {}
+    for filepath in filepaths:
+        try:
+            signature = get_stat_signature(filepath)
+        except OSError:
+            continue
+        if manifest.get(filepath) != signature:
+            signatures[filepath] = signature
+
+    print(f"Ingesting {len(signatures)} changed files")
+    if signatures:
+        store_modified_files(db_engine, signatures)
+        generate_embeddings.generate_embeddings()
+        generate_thumbnails.generate_thumbnails()
+
+
+def start_observer(collector: ChangeCollector, library_path: str) -> Observer:
+    """
+    Start an inotify based observer, falling back to polling when inotify is
+    not available (e.g. on network shares or when the watch limit is reached)
+    """
+    if not os.environ.get("WATCH_POLLING"):
+        try:
+            observer = Observer()
+            observer.schedule(collector, library_path, recursive=True)
+            observer.start()
+            return observer
+        except OSError as error:
+            print(f"Native file system events unavailable, falling back to polling: {error}")
+
+    observer = PollingObserver(timeout=WATCH_POLLING_INTERVAL_SECONDS)
+    observer.schedule(collector, library_path, recursive=True)
+    observer.start()
+    return observer
+
+
+def watch_library():
+    """
+    Watch the library for created, modified, moved and deleted files and ingest them in debounced batches
+    """
+    collector = ChangeCollector()
+    observer = start_observer(collector, os.environ["LIBRARY_PATH"])
+    print(f"Watching {os.environ['LIBRARY_PATH']} for changes")
+
+    try:
+        while observer.is_alive():
+            batch = collector.pop_batch()
+            if batch is not None:
+                changed, deleted = batch
+                ingest_changes(sorted(changed), sorted(deleted))
+            else:
+                time.sleep(1)
+    finally:
+        observer.stop()
+        observer.join()
+
+
+if __name__ == "__main__":
+    watch_library()
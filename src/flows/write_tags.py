@@ -1,29 +1,44 @@
 """Write person tags back to the original source files in the photo library"""
 
 import os
+from datetime import datetime
 
 from dotenv import load_dotenv
 from prefect import flow, task
-from sqlalchemy import create_engine, select, outerjoin
-from exiftool import ExifToolHelper
+from sqlalchemy import Engine, bindparam, create_engine, func, or_, select, outerjoin
 from collections import defaultdict
+from exiftool import ExifToolHelper
 
-from src.utils.tables import files as files_table, persons as persons_table, faces as faces_table
+from src.utils.exif import read_subject_tags, write_subject_tags_parallel
+from src.utils.hashing import get_hash_workers, get_stat_signature, hash_files
+from src.utils.tables import (
+    files as files_table,
+    manifest as manifest_table,
+    persons as persons_table,
+    faces as faces_table,
+)
+from src.utils.xmp_sidecar import get_sidecar_path, write_own_sidecar
 
 load_dotenv()  # Inject environment variables from .env during development
 
+# "embedded" writes the tags into the photos themselves, "sidecar" into XMP sidecar files
+WRITE_TAGS_MODE = os.environ.get("WRITE_TAGS_MODE", "embedded")
 
-@flow()
-def write_tags():
+
+@task()
+def load_tagged_files(
+    db_engine: Engine,
+) -> tuple[dict[str, set[str]], dict[str, set[str]], dict[str, set[str]]]:
     """
-    Find tagged persons in the database and write them in the XMP Subject to the original source files
+    Load the names of the tagged persons of every file, together with the XMP Subject
+    the file was last read or written with and the names last written to its sidecar
     """
-    db_engine = create_engine("sqlite:///" + os.environ["DATABASE_PATH"])
-    
     with db_engine.connect() as conn:
         # Find all files with confirmed tagged persons
         query = select(
             files_table.c.path,
+            files_table.c.subject_tags,
+            files_table.c.sidecar_tags,
             persons_table.c.name
         ).select_from(
             outerjoin(
@@ -31,23 +46,291 @@ def write_tags():
             persons_table, faces_table.c.person_id == persons_table.c.id
             )
         ).where(faces_table.c.person_id.isnot(None), faces_table.c.person_id != 0)
-        
-        results = conn.execute(query)
 
-        # Group names by file path
-        tags_by_file = defaultdict(list)
-        for result in results:
-            file_path, person_name = result
-            tags_by_file[file_path].append(person_name)
+        # Group names by file path, a person can be tagged on several faces of a file
+        names_by_file = defaultdict(set)
+        subject_by_file = {}
+        sidecar_by_file = {}
+        for file_path, subject_tags, sidecar_tags, person_name in conn.execute(query):
+            names_by_file[file_path].add(person_name)
+            subject_by_file[file_path] = set(subject_tags or [])
+            sidecar_by_file[file_path] = set(sidecar_tags or [])
+
+    return names_by_file, subject_by_file, sidecar_by_file
+
+
+@task()
+def load_untagged_files(
+    db_engine: Engine,
+) -> tuple[dict[str, set[str]], dict[str, set[str]], set[str]]:
+    """
+    Load the XMP Subject and sidecar names of the files without tagged persons that may
+    still hold names written before, e.g. after their last face was unlabeled, together
+    with the names of all persons
+    """
+    tagged_files = select(faces_table.c.file_id).where(
+        faces_table.c.person_id.isnot(None), faces_table.c.person_id != 0
+    )
+    query = select(
+        files_table.c.path,
+        files_table.c.subject_tags,
+        files_table.c.sidecar_tags
+    ).where(
+        files_table.c.id.not_in(tagged_files),
+        or_(
+            func.json_array_length(files_table.c.subject_tags) > 0,
+            func.json_array_length(files_table.c.sidecar_tags) > 0,
+        ),
+    )
+
+    with db_engine.connect() as conn:
+        subject_by_file = {}
+        sidecar_by_file = {}
+        for file_path, subject_tags, sidecar_tags in conn.execute(query):
+            subject_by_file[file_path] = set(subject_tags or [])
+            sidecar_by_file[file_path] = set(sidecar_tags or [])
+
+        # The 'Ignored' person with id 0 is never written
+        person_names = set(
+            conn.execute(
+                select(persons_table.c.name).where(persons_table.c.id > 0)
+            ).scalars()
+        )
+
+    return subject_by_file, sidecar_by_file, person_names
+
+
+def group_by_names(names_by_file: dict[str, set[str]]) -> dict[tuple[str, ...], list[str]]:
+    """
+    Group files by the names to write, so files with the same names are written in batches
+    """
+    files_by_names = defaultdict(list)
+    for file_path, names in names_by_file.items():
+        files_by_names[tuple(sorted(names))].append(file_path)
+    return files_by_names
+
+
+def find_changed_tags(
+    names_by_file: dict[str, set[str]],
+    subject_by_file: dict[str, set[str]],
+    person_names: set[str],
+) -> dict[tuple[str, ...], list[str]]:
+    """
+    Find the files whose tagged persons differ from the person names in the XMP Subject
+    they were last read or written with, grouped by the Subject to write. Only the person
+    names are replaced, so the other keywords of a file are kept.
+    """
+    files_by_subject = group_by_names(
+        {
+            file_path: (subject_by_file[file_path] - person_names) | names
+            for file_path, names in names_by_file.items()
+            if names != subject_by_file[file_path] & person_names
+        }
+    )
+
+    unchanged = len(names_by_file) - sum(len(paths) for paths in files_by_subject.values())
+    print(f"Skipping {unchanged} files whose XMP Subject is up to date")
+
+    return files_by_subject
+
+
+@task()
+def write_sidecars(
+    names_by_file: dict[str, set[str]], sidecar_by_file: dict[str, set[str]]
+) -> list[str]:
+    """
+    Write the tagged persons to XMP sidecars next to the files instead of the files
+    themselves, only rewriting sidecars whose content changes. Sidecars of other
+    applications are updated through ExifTool, replacing only the names written before
+    so their other keywords and tags are kept. Returns the files whose sidecar is up to date.
+    """
+    # Photos sharing a basename share their sidecar with the basename naming
+    names_by_sidecar = defaultdict(set)
+    written_by_sidecar = defaultdict(set)
+    files_by_sidecar = defaultdict(list)
+    for file_path, names in names_by_file.items():
+        sidecar_path = get_sidecar_path(file_path)
+        names_by_sidecar[sidecar_path].update(names)
+        written_by_sidecar[sidecar_path].update(sidecar_by_file.get(file_path, set()))
+        files_by_sidecar[sidecar_path].append(file_path)
+
+    written = 0
+    current_sidecars = []
+    foreign_sidecars = {}
+    for sidecar_path, names in names_by_sidecar.items():
+        try:
+            result = write_own_sidecar(
+                sidecar_path, sorted(names), files_by_sidecar[sidecar_path][0]
+            )
+        except OSError as error:
+            print(f"Failed to write sidecar {sidecar_path}: {error}")
+            continue
+
+        if result is None:
+            foreign_sidecars[sidecar_path] = names
+            continue
+
+        current_sidecars.append(sidecar_path)
+        if result:
+            written += 1
 
-        # Write tags to files
+    if foreign_sidecars:
         with ExifToolHelper() as et:
-            for file_path, names in tags_by_file.items():
-                et.set_tags(
-                    [file_path],
-                    tags={"Subject": names}
-                )
-                print(f"Writting to {file_path} XMP Subject Tag = {', '.join(names)}")
+            subjects = read_subject_tags(et, list(foreign_sidecars))
+        changed = {}
+        for sidecar_path, names in foreign_sidecars.items():
+            if sidecar_path not in subjects:
+                continue  # Unreadable, so its keywords can't be kept
+            existing = set(subjects[sidecar_path])
+            subject = (existing - written_by_sidecar[sidecar_path]) | names
+            if subject != existing:
+                changed[sidecar_path] = subject
+            else:
+                current_sidecars.append(sidecar_path)
+
+        # Without -overwrite_original, ExifTool keeps a backup of every sidecar it updates
+        written_sidecars = write_subject_tags_parallel(
+            group_by_names(changed), params=["-overwrite_original"]
+        )
+        current_sidecars.extend(written_sidecars)
+        written += len(written_sidecars)
+
+    unchanged = len(names_by_sidecar) - written
+    print(f"Wrote {written} sidecars, {unchanged} sidecars were up to date or failed")
+    return [
+        file_path
+        for sidecar_path in current_sidecars
+        for file_path in files_by_sidecar[sidecar_path]
+    ]
+
+
+@task()
+def store_sidecar_tags(db_engine: Engine, sidecar_tags: dict[str, set[str]]):
+    """
+    Store the names written to the sidecars of the given files
+    """
+    values = [
+        {"file_path": file_path, "sidecar_tags": sorted(names)}
+        for file_path, names in sidecar_tags.items()
+    ]
+    if not values:
+        return
+
+    with db_engine.begin() as conn:
+        conn.execute(
+            files_table.update()
+            .where(files_table.c.path == bindparam("file_path"))
+            .values(sidecar_tags=bindparam("sidecar_tags")),
+            values,
+        )
+
+
+@task()
+def store_written_tags(db_engine: Engine, written: dict[str, list[str]]):
+    """
+    Store the written tags with the new hash and stat signature of the rewritten files,
+    so the next scan doesn't take them for modified and detect their faces again
+    """
+    file_hashes = hash_files(list(written), get_hash_workers(os.environ["LIBRARY_PATH"]))
+
+    files_values = []
+    manifest_values = []
+    for file_path, file_hash in file_hashes.items():
+        try:
+            size, mtime_ns, inode, device = get_stat_signature(file_path)
+        except OSError:
+            continue  # Removed in the meantime, picked up by the next scan
+
+        files_values.append(
+            {
+                "file_path": file_path,
+                "hash": file_hash,
+                "last_updated": datetime.fromtimestamp(mtime_ns / 1e9),
+                "subject_tags": written[file_path],
+            }
+        )
+        manifest_values.append(
+            {
+                "file_path": file_path,
+                "size": size,
+                "mtime_ns": mtime_ns,
+                "inode": inode,
+                "device": device,
+            }
+        )
+
+    if not files_values:
+        return
+
+    with db_engine.begin() as conn:
+        conn.execute(
+            files_table.update()
+            .where(files_table.c.path == bindparam("file_path"))
+            .values(
+                hash=bindparam("hash"),
+                last_updated=bindparam("last_updated"),
+                subject_tags=bindparam("subject_tags"),
+            ),
+            files_values,
+        )
+        conn.execute(
+            manifest_table.update()
+            .where(manifest_table.c.path == bindparam("file_path"))
+            .values(
+                size=bindparam("size"),
+                mtime_ns=bindparam("mtime_ns"),
+                inode=bindparam("inode"),
+                device=bindparam("device"),
+            ),
+            manifest_values,
+        )
+
+
+@flow()
+def write_tags():
+    """
+    Find tagged persons in the database and write them in the XMP Subject to the original
+    source files or their XMP sidecars, only rewriting those whose tagged persons changed
+    """
+    db_engine = create_engine("sqlite:///" + os.environ["DATABASE_PATH"])
+
+    names_by_file, subject_by_file, sidecar_by_file = load_tagged_files(db_engine)
+    untagged_subjects, untagged_sidecars, person_names = load_untagged_files(db_engine)
+
+    if WRITE_TAGS_MODE == "sidecar":
+        # Sidecars of files whose last face was unlabeled lose the names written before
+        for file_path, sidecar_tags in untagged_sidecars.items():
+            if sidecar_tags:
+                names_by_file[file_path] = set()
+                sidecar_by_file[file_path] = sidecar_tags
+
+        # The original files are never modified, so their hash and signature stay valid
+        current = write_sidecars(names_by_file, sidecar_by_file)
+        store_sidecar_tags(
+            db_engine,
+            {
+                file_path: names_by_file[file_path]
+                for file_path in current
+                if names_by_file[file_path] != sidecar_by_file[file_path]
+            },
+        )
+        return
+
+    # Files whose last face was unlabeled lose the person names in their Subject
+    for file_path, subject in untagged_subjects.items():
+        if subject & person_names:
+            names_by_file[file_path] = set()
+            subject_by_file[file_path] = subject
+
+    files_by_subject = find_changed_tags(names_by_file, subject_by_file, person_names)
+
+    # Write tags to files
+    written = write_subject_tags_parallel(files_by_subject)
+    for subject, file_paths in files_by_subject.items():
+        print(f"Writing XMP Subject Tag = {', '.join(subject)} to {len(file_paths)} files")
+
+    store_written_tags(db_engine, written)
+    print(f"Wrote tags to {len(written)} files")
 
 
 if __name__ == "__main__":
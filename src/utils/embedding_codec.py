@@ -0,0 +1,70 @@
+"""Normalization and compact encodings of face embeddings"""
+
+import os
+
+import numpy as np
+
+# Distance metric between embeddings: "l2" on the raw Facenet embeddings, or "cosine" to
+# L2-normalize the embeddings and search the Faiss indexes by inner product
+EMBEDDING_METRIC = os.environ.get("EMBEDDING_METRIC", "l2")
+# Encoding of the embeddings stored in the database and embedding store: "float32",
+# "float16" or "sq8", which needs the cosine metric as it relies on the fixed -1..1 range
+EMBEDDING_ENCODING = os.environ.get("EMBEDDING_ENCODING", "float32")
+
+ENCODING_DTYPES = {"float32": np.float32, "float16": np.float16, "sq8": np.int8}
+# Scale of 8-bit encoded components of normalized embeddings
+SQ8_SCALE = 127
+
+
+def prepare_embeddings(embeddings, metric: str = EMBEDDING_METRIC) -> np.ndarray:
+    """
+    Convert embeddings to a float32 matrix as used by Faiss, normalized for the cosine metric
+    """
+    embeddings = np.array(embeddings, dtype=np.float32, ndmin=2)
+    if metric == "cosine":
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        embeddings /= np.maximum(norms, np.finfo(np.float32).tiny)
+    return embeddings
+
+
+def encode_embeddings(
+    embeddings: np.ndarray,
+    encoding: str = EMBEDDING_ENCODING,
+    metric: str = EMBEDDING_METRIC,
+) -> np.ndarray:
+    """
+    Encode prepared embeddings with the given encoding
+    """
+    if encoding == "sq8":
+        if metric != "cosine":
+            raise ValueError("The sq8 embedding encoding requires the cosine embedding metric")
+        return np.round(np.clip(embeddings, -1, 1) * SQ8_SCALE).astype(np.int8)
+
+    return np.asarray(embeddings, dtype=ENCODING_DTYPES[encoding])
+
+
+def decode_embeddings(encoded: np.ndarray) -> np.ndarray:
+    """
+    Decode embeddings of any encoding back to float32, based on their data type
+    """
+    if encoded.dtype == np.int8:
+        return encoded.astype(np.float32) / SQ8_SCALE
+    return np.asarray(encoded, dtype=np.float32)
+
+
+def encode_embedding(embedding: np.ndarray) -> bytes:
+    """
+    Encode a single prepared embedding for storage in the database
+    """
+    return encode_embeddings(embedding).tobytes()
+
+
+def decode_embedding(data: bytes, dimension: int) -> np.ndarray:
+    """
+    Decode an embedding stored in the database, recognizing the encoding by its length,
+    so embeddings stored before the encoding was changed can still be read
+    """
+    dtype = {
+        np.dtype(dtype).itemsize: dtype for dtype in ENCODING_DTYPES.values()
+    }[len(data) // dimension]
+    return decode_embeddings(np.frombuffer(data, dtype=dtype))
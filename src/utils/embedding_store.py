@@ -0,0 +1,198 @@
+"""Append-only, memory-mapped store of all face embeddings"""
+
+import os
+
+import numpy as np
+from sqlalchemy import select
+
+from .embedding_codec import (
+    EMBEDDING_ENCODING,
+    ENCODING_DTYPES,
+    decode_embedding,
+    decode_embeddings,
+    encode_embeddings,
+)
+from .tables import faces as faces_table
+
+# Number of embeddings loaded from the database at once while reconciling
+RECONCILE_BATCH_SIZE = 500
+
+
+class EmbeddingStore:
+    """
+    Stores all embeddings as one contiguous float32 matrix in a file, with the face id of
+    every row in a parallel file, so analysis passes can memory-map all embeddings without
+    copying or decoding them row by row. When a face id occurs more than once, the last
+    row is the current embedding of that face. The rows use the configured embedding
+    encoding, which is recorded next to the store.
+    """
+
+    def __init__(self, path: str, dimension: int, encoding: str = EMBEDDING_ENCODING):
+        self.path = path
+        self.ids_path = path + ".ids"
+        self.encoding_path = path + ".encoding"
+        self.dimension = dimension
+        self.encoding = encoding
+        self.dtype = ENCODING_DTYPES[encoding]
+        self.row_size = dimension * np.dtype(self.dtype).itemsize
+        self.pending_ids = []
+        self.pending_embeddings = []
+
+    def get_stored_encoding(self) -> str | None:
+        """
+        Get the encoding the store was written with, None when the store doesn't exist
+        """
+        if not os.path.exists(self.path):
+            return None
+        if not os.path.exists(self.encoding_path):
+            # Stores written before encodings were supported hold float32 rows
+            return "float32"
+        with open(self.encoding_path, encoding="utf-8") as f:
+            return f.read().strip()
+
+    def clear(self):
+        """
+        Remove all rows, so the store can be rebuilt with another encoding
+        """
+        for path in (self.path, self.ids_path, self.encoding_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def __len__(self) -> int:
+        # A crash can leave a partially appended row behind, only count complete rows
+        if not os.path.exists(self.path) or not os.path.exists(self.ids_path):
+            return 0
+        return min(
+            os.path.getsize(self.path) // self.row_size,
+            os.path.getsize(self.ids_path) // np.dtype(np.int64).itemsize,
+        )
+
+    def append(self, ids: list[int], embeddings: np.ndarray):
+        """
+        Append the embeddings of the given face ids, they are written on the next sync
+        """
+        self.pending_ids.extend(ids)
+        self.pending_embeddings.append(
+            encode_embeddings(embeddings, self.encoding).reshape(-1, self.dimension)
+        )
+
+    def sync(self):
+        """
+        Write all appended embeddings to the end of the store and flush them to disk
+        """
+        if not self.pending_ids:
+            return
+
+        if not os.path.exists(self.encoding_path):
+            with open(self.encoding_path, "w", encoding="utf-8") as f:
+                f.write(self.encoding)
+
+        rows = len(self)
+        for path, row_size, data in (
+            (self.path, self.row_size, np.concatenate(self.pending_embeddings)),
+            (
+                self.ids_path,
+                np.dtype(np.int64).itemsize,
+                np.asarray(self.pending_ids, dtype=np.int64),
+            ),
+        ):
+            with open(path, "r+b" if os.path.exists(path) else "wb") as f:
+                # Overwrite any partially written row of an interrupted sync
+                f.seek(rows * row_size)
+                f.write(data.tobytes())
+                f.truncate()
+                f.flush()
+                os.fsync(f.fileno())
+
+        self.pending_ids = []
+        self.pending_embeddings = []
+
+    def load(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Memory-map the face ids and the encoded embeddings matrix of all rows in the store
+        """
+        rows = len(self)
+        if rows == 0:
+            return (
+                np.empty(0, dtype=np.int64),
+                np.empty((0, self.dimension), dtype=self.dtype),
+            )
+
+        ids = np.memmap(self.ids_path, dtype=np.int64, mode="r", shape=(rows,))
+        embeddings = np.memmap(
+            self.path, dtype=self.dtype, mode="r", shape=(rows, self.dimension)
+        )
+        return ids, embeddings
+
+    def load_rows(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Memory-map all embeddings and map every face id to its current row, -1 when unknown
+        """
+        ids, embeddings = self.load()
+        rows = np.full(int(ids.max()) + 1 if len(ids) else 0, -1, dtype=np.int64)
+        # Later rows overwrite earlier rows of the same face id
+        rows[ids] = np.arange(len(ids), dtype=np.int64)
+        return rows, embeddings
+
+
+def is_stored(rows: np.ndarray, face_ids: np.ndarray) -> np.ndarray:
+    """
+    Mask of the given face ids that have a row in a memory-mapped store
+    """
+    face_ids = np.asarray(face_ids, dtype=np.int64)
+    stored = (face_ids >= 0) & (face_ids < len(rows))
+    stored[stored] = rows[face_ids[stored]] >= 0
+    return stored
+
+
+def get_embeddings(
+    rows: np.ndarray, embeddings: np.ndarray, face_ids: np.ndarray
+) -> np.ndarray:
+    """
+    Get the decoded embeddings of the given face ids from a memory-mapped store, raises
+    a ValueError when a face isn't stored instead of returning the row of another face
+    """
+    stored = is_stored(rows, face_ids)
+    if not stored.all():
+        missing = np.asarray(face_ids)[~stored]
+        raise ValueError(
+            f"{len(missing)} faces are not in the embedding store, e.g. {missing[:5].tolist()}"
+        )
+    return decode_embeddings(np.asarray(embeddings[rows[face_ids]]))
+
+
+def reconcile_store(conn, store: EmbeddingStore) -> int:
+    """
+    Append the stored embeddings of faces that are missing from the store, e.g. after an
+    interrupted run or when the store didn't exist yet. Returns the number of appended faces.
+    """
+    # Rebuild the store from the database when the embedding encoding was changed
+    stored_encoding = store.get_stored_encoding()
+    if stored_encoding not in (None, store.encoding):
+        print(f"Rebuilding embedding store from {stored_encoding} to {store.encoding}")
+        store.clear()
+
+    face_ids = np.array(
+        conn.execute(select(faces_table.c.id)).scalars().all(), dtype=np.int64
+    )
+    store_ids, _ = store.load()
+    missing_ids = np.setdiff1d(face_ids, store_ids)
+
+    for start in range(0, len(missing_ids), RECONCILE_BATCH_SIZE):
+        batch = missing_ids[start : start + RECONCILE_BATCH_SIZE].tolist()
+        result = conn.execute(
+            select(faces_table.c.id, faces_table.c.embedding).where(
+                faces_table.c.id.in_(batch)
+            )
+        ).all()
+        store.append(
+            [row.id for row in result],
+            np.stack([decode_embedding(row.embedding, store.dimension) for row in result]),
+        )
+
+        store.sync()
+
+    if len(missing_ids) > 0:
+        print(f"Reconciled embedding store: added {len(missing_ids)} missing faces")
+
+    return len(missing_ids)
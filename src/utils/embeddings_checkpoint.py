@@ -0,0 +1,139 @@
+"""Saves the database, embedding store and Faiss index consistently during a flow"""
+
+import os
+import time
+
+import faiss
+import numpy as np
+
+from .embedding_store import EmbeddingStore, reconcile_store
+from .embeddings_index import (
+    promote_index_if_needed,
+    read_index,
+    reconcile_index,
+    remove_index_ids,
+    write_index,
+)
+from .garbage import remove_orphaned_thumbnails
+from .persons_index import refresh_persons
+from .processing_state import INDEX_GENERATION, get_state, set_state
+
+# Seconds after which the embedding store and Faiss index are saved, time based as writing
+# the whole index takes longer the larger the library gets
+EMBEDDING_CHECKPOINT_SECONDS = float(os.environ.get("EMBEDDING_CHECKPOINT_SECONDS", 300))
+
+
+class Checkpointer:
+    """
+    Commits the database after every file, so other flows and the web interface are never
+    locked out for long, and syncs the embedding store and atomically writes the Faiss index
+    at a regular interval. Faces missing from those after a crash are recovered from the
+    database when they are opened again.
+    """
+
+    def __init__(
+        self,
+        conn,
+        index: faiss.Index,
+        store: EmbeddingStore,
+        interval: float = EMBEDDING_CHECKPOINT_SECONDS,
+    ):
+        self.conn = conn
+        self.index = index
+        self.store = store
+        self.interval = interval
+        self.last_checkpoint = time.monotonic()
+        self.pending = 0
+        self.discarded_ids = []
+        self.discarded_thumbnails = set()
+        self.changed_persons = set()
+
+    def file_done(self):
+        """
+        Commit a processed file, creating a checkpoint when the interval has passed
+        """
+        self.conn.commit()
+        self.pending += 1
+        if time.monotonic() - self.last_checkpoint >= self.interval:
+            self.checkpoint()
+
+    def discard(self, face_ids: list[int], thumbnails: set[str], person_ids: set[int]):
+        """
+        Register faces deleted from the database, which are removed from the index in a single
+        batch at the next checkpoint together with their thumbnails when no longer used
+        """
+        self.discarded_ids.extend(face_ids)
+        self.discarded_thumbnails.update(thumbnails)
+        self.changed_persons.update(person_ids)
+
+    def persons_changed(self, person_ids: set[int]):
+        """
+        Register persons that got labeled faces without a label change, e.g. copied from
+        a byte-identical file, whose prototypes are recomputed at the next checkpoint
+        """
+        self.changed_persons.update(person_ids)
+
+    def checkpoint(self):
+        """
+        Commit the database before writing the embedding store and index, as faces missing
+        from those can be recovered from the database but not the other way around
+        """
+        self.conn.commit()
+        self.store.sync()
+
+        if self.discarded_ids:
+            self.index = remove_index_ids(
+                self.index, np.array(self.discarded_ids, dtype=np.int64), self.store
+            )
+        write_index(self.index, os.environ["EMBEDDINGS_INDEX_PATH"])
+        self.pending = 0
+        self.last_checkpoint = time.monotonic()
+
+        if self.discarded_ids or self.discarded_thumbnails:
+            removed = remove_orphaned_thumbnails(
+                self.conn, self.discarded_thumbnails, os.environ["THUMBNAILS_PATH"]
+            )
+            print(
+                f"Removed {len(self.discarded_ids)} faces from the index "
+                f"and {removed} orphaned thumbnails"
+            )
+            self.discarded_ids = []
+            self.discarded_thumbnails = set()
+
+        if self.changed_persons:
+            refresh_persons(self.conn, list(self.changed_persons))
+            self.changed_persons = set()
+
+    def finish(self) -> faiss.Index:
+        """
+        Create a final checkpoint and migrate the index to a scalable type once it
+        grew large enough, returns the index to use from now on
+        """
+        self.checkpoint()
+
+        promoted_index = promote_index_if_needed(self.index, self.store)
+        if promoted_index is not self.index:
+            self.index = promoted_index
+            write_index(self.index, os.environ["EMBEDDINGS_INDEX_PATH"])
+
+            # Search results of the new index differ, so recognition has to evaluate all faces again
+            set_state(self.conn, INDEX_GENERATION, get_state(self.conn, INDEX_GENERATION) + 1)
+            self.conn.commit()
+
+        return self.index
+
+
+def open_embeddings(conn, dimension: int) -> tuple[faiss.Index, EmbeddingStore]:
+    """
+    Open the Faiss index and embedding store and recover any embeddings lost by an interrupted run
+    """
+    store = EmbeddingStore(os.environ["EMBEDDINGS_STORE_PATH"], dimension)
+    reconcile_store(conn, store)
+
+    index, changed = reconcile_index(
+        conn, read_index(os.environ["EMBEDDINGS_INDEX_PATH"]), store
+    )
+    if changed:
+        write_index(index, os.environ["EMBEDDINGS_INDEX_PATH"])
+
+    return index, store
@@ -0,0 +1,313 @@
+"""Helpers to read, write and reconcile the Faiss embeddings index"""
+
+import os
+
+import faiss
+import numpy as np
+from sqlalchemy import select
+
+from .embedding_codec import EMBEDDING_METRIC, decode_embedding
+from .embedding_store import EmbeddingStore, get_embeddings
+from .tables import faces as faces_table
+
+# Number of embeddings loaded from the database at once while reconciling
+RECONCILE_BATCH_SIZE = 500
+
+# Type of index used once the number of faces passes the promotion threshold: "flat" (exact
+# search), "fp16" or "sq8" (compressed exact search), "ivf_flat", "ivf_sq8", "ivf_pq" or "hnsw"
+EMBEDDINGS_INDEX_TYPE = os.environ.get("EMBEDDINGS_INDEX_TYPE", "ivf_flat")
+# Number of faces after which the exact flat index is migrated to the configured index type
+INDEX_PROMOTION_THRESHOLD = int(os.environ.get("INDEX_PROMOTION_THRESHOLD", 1_000_000))
+# Number of inverted lists probed per search of an IVF index, trading speed for recall
+IVF_NPROBE = int(os.environ.get("IVF_NPROBE", 16))
+# Number of sub-quantizers of an IVF-PQ index, which must divide the embedding dimension
+IVF_PQ_SUBQUANTIZERS = 16
+# Minimum number of training vectors per IVF list Faiss needs for good centroids
+IVF_TRAINING_PER_LIST = 39
+# Minimum number of faces before an IVF index can be trained, as PQ needs 256 centroids
+IVF_MIN_TRAINING_SIZE = 10000
+# Maximum number of embeddings used to train an IVF index
+IVF_MAX_TRAINING_SIZE = 256 * 1024
+# Number of neighbors per node in the HNSW graph
+HNSW_M = 32
+# Size of the candidate list while searching the HNSW graph, trading speed for recall
+HNSW_EF_SEARCH = int(os.environ.get("HNSW_EF_SEARCH", 64))
+# Number of embeddings added to a new index at once while migrating
+MIGRATION_BATCH_SIZE = 65536
+
+# Index types that have to be trained on existing embeddings before use
+TRAINED_INDEX_TYPES = ("sq8", "ivf_flat", "ivf_sq8", "ivf_pq")
+IVF_INDEX_TYPES = ("ivf_flat", "ivf_sq8", "ivf_pq")
+FAISS_METRICS = {"l2": faiss.METRIC_L2, "cosine": faiss.METRIC_INNER_PRODUCT}
+
+
+def get_index_type(index: faiss.Index) -> str:
+    """
+    Get the type of the index as used in the EMBEDDINGS_INDEX_TYPE configuration
+    """
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        if isinstance(ivf, faiss.IndexIVFPQ):
+            return "ivf_pq"
+        if isinstance(ivf, faiss.IndexIVFScalarQuantizer):
+            return "ivf_sq8"
+        return "ivf_flat"
+
+    storage = faiss.downcast_index(index.index)
+    if isinstance(storage, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(storage, faiss.IndexScalarQuantizer):
+        return "sq8" if storage.sq.qtype == faiss.ScalarQuantizer.QT_8bit else "fp16"
+    return "flat"
+
+
+def configure_search(index: faiss.Index):
+    """
+    Set the search parameters of approximate indexes
+    """
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.nprobe = IVF_NPROBE
+    elif get_index_type(index) == "hnsw":
+        faiss.downcast_index(index.index).hnsw.efSearch = HNSW_EF_SEARCH
+
+
+def get_ivf_lists(size: int) -> int:
+    """
+    Get the number of inverted lists for an IVF index of the given size, using the common
+    rule of thumb of 4 * sqrt(n) while keeping enough training vectors per list
+    """
+    return max(1, min(int(4 * np.sqrt(size)), size // IVF_TRAINING_PER_LIST))
+
+
+def create_index(
+    dimension: int,
+    index_type: str,
+    training_embeddings: np.ndarray | None = None,
+    metric: str = EMBEDDING_METRIC,
+) -> faiss.Index:
+    """
+    Create an empty index of the given type, the ids of the added embeddings are always
+    the faces.id primary keys. Trained index types are trained on the given embeddings.
+    """
+    faiss_metric = FAISS_METRICS[metric]
+
+    if index_type == "flat":
+        if faiss_metric == faiss.METRIC_INNER_PRODUCT:
+            return faiss.IndexIDMap(faiss.IndexFlatIP(dimension))
+        return faiss.IndexIDMap(faiss.IndexFlatL2(dimension))
+
+    if index_type in ("fp16", "sq8"):
+        qtype = (
+            faiss.ScalarQuantizer.QT_fp16
+            if index_type == "fp16"
+            else faiss.ScalarQuantizer.QT_8bit
+        )
+        index = faiss.IndexScalarQuantizer(dimension, qtype, faiss_metric)
+        if index_type == "sq8":
+            index.train(np.ascontiguousarray(training_embeddings, dtype=np.float32))
+        return faiss.IndexIDMap(index)
+
+    if index_type == "hnsw":
+        # HNSW can't store ids itself, IndexIDMap2 also supports looking up vectors by id
+        return faiss.IndexIDMap2(faiss.IndexHNSWFlat(dimension, HNSW_M, faiss_metric))
+
+    if index_type in IVF_INDEX_TYPES:
+        lists = get_ivf_lists(len(training_embeddings))
+        if faiss_metric == faiss.METRIC_INNER_PRODUCT:
+            quantizer = faiss.IndexFlatIP(dimension)
+        else:
+            quantizer = faiss.IndexFlatL2(dimension)
+
+        if index_type == "ivf_flat":
+            index = faiss.IndexIVFFlat(quantizer, dimension, lists, faiss_metric)
+        elif index_type == "ivf_sq8":
+            index = faiss.IndexIVFScalarQuantizer(
+                quantizer, dimension, lists, faiss.ScalarQuantizer.QT_8bit, faiss_metric
+            )
+        else:
+            index = faiss.IndexIVFPQ(
+                quantizer, dimension, lists, IVF_PQ_SUBQUANTIZERS, 8, faiss_metric
+            )
+        index.train(np.ascontiguousarray(training_embeddings, dtype=np.float32))
+        configure_search(index)
+        return index
+
+    raise ValueError(f"Unknown embeddings index type: {index_type}")
+
+
+def migrate_index(
+    index: faiss.Index,
+    store: EmbeddingStore,
+    index_type: str,
+    ids: np.ndarray | None = None,
+) -> faiss.Index:
+    """
+    Build a new index of the given type holding all embeddings of the current index, or only
+    the given ids, using the embedding store so the ids stay the faces.id primary keys
+    """
+    ids = np.sort(get_index_ids(index) if ids is None else ids)
+    store_rows, embeddings = store.load_rows()
+
+    training_embeddings = None
+    if index_type in TRAINED_INDEX_TYPES:
+        rng = np.random.default_rng(0)
+        sample = rng.choice(ids, size=min(len(ids), IVF_MAX_TRAINING_SIZE), replace=False)
+        training_embeddings = get_embeddings(store_rows, embeddings, np.sort(sample))
+
+    new_index = create_index(index.d, index_type, training_embeddings, get_index_metric(index))
+    for start in range(0, len(ids), MIGRATION_BATCH_SIZE):
+        batch = ids[start : start + MIGRATION_BATCH_SIZE]
+        new_index.add_with_ids(get_embeddings(store_rows, embeddings, batch), batch)
+
+    print(
+        f"Migrated embeddings index from {get_index_type(index)} to {index_type} "
+        f"holding {new_index.ntotal} faces"
+    )
+    return new_index
+
+
+def promote_index_if_needed(index: faiss.Index, store: EmbeddingStore) -> faiss.Index:
+    """
+    Migrate a flat index to the configured index type once it holds more faces than the
+    promotion threshold, and retrain an IVF index once it outgrew its number of lists.
+    Returns the new index, or the same index when nothing changed.
+    """
+    index_type = get_index_type(index)
+
+    if index_type == "flat":
+        threshold = INDEX_PROMOTION_THRESHOLD
+        if EMBEDDINGS_INDEX_TYPE in TRAINED_INDEX_TYPES:
+            threshold = max(threshold, IVF_MIN_TRAINING_SIZE)
+
+        if EMBEDDINGS_INDEX_TYPE != "flat" and index.ntotal >= threshold:
+            return migrate_index(index, store, EMBEDDINGS_INDEX_TYPE)
+    elif index_type in IVF_INDEX_TYPES:
+        if get_ivf_lists(index.ntotal) >= 2 * faiss.extract_index_ivf(index).nlist:
+            return migrate_index(index, store, index_type)
+
+    return index
+
+
+def get_index_metric(index: faiss.Index) -> str:
+    """
+    Get the embedding metric the index was created for
+    """
+    return "cosine" if index.metric_type == faiss.METRIC_INNER_PRODUCT else "l2"
+
+
+def read_index(path: str) -> faiss.Index:
+    """
+    Read the Faiss index from disk, ready for searching
+    """
+    index = faiss.read_index(path)
+    if get_index_metric(index) != EMBEDDING_METRIC:
+        raise ValueError(
+            f"Index {path} was created for the {get_index_metric(index)} embedding metric, "
+            f"run the cleanup flow to start over with the {EMBEDDING_METRIC} metric"
+        )
+
+    configure_search(index)
+    return index
+
+
+def search_index(
+    index: faiss.Index, embeddings: np.ndarray, k: int
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Search the k nearest neighbors of a batch of embeddings, returning squared L2 distances
+    for both metrics so the same thresholds apply. Missing results have distance inf and id -1.
+    """
+    distances, ids = index.search(np.ascontiguousarray(embeddings, dtype=np.float32), k)
+    if index.metric_type == faiss.METRIC_INNER_PRODUCT:
+        # For normalized embeddings the squared L2 distance is 2 - 2 * their inner product
+        distances = np.maximum(2 - 2 * distances, 0)
+    return np.where(ids >= 0, distances, np.inf), ids
+
+
+def write_index(index: faiss.Index, path: str):
+    """
+    Write the Faiss index to disk atomically, so a crash while writing never leaves
+    a truncated index behind
+    """
+    temporary_path = path + ".tmp"
+    faiss.write_index(index, temporary_path)
+
+    # Make sure the data is on disk before the rename makes it visible
+    with open(temporary_path, "rb") as f:
+        os.fsync(f.fileno())
+    os.replace(temporary_path, path)
+
+
+def get_index_ids(index: faiss.Index) -> np.ndarray:
+    """
+    Get the ids of all embeddings stored in the index
+    """
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is None:
+        return faiss.vector_to_array(index.id_map)
+
+    # IVF indexes store the ids in their inverted lists
+    invlists = ivf.invlists
+    return np.concatenate(
+        [np.empty(0, dtype=np.int64)]
+        + [
+            faiss.rev_swig_ptr(invlists.get_ids(i), invlists.list_size(i)).copy()
+            for i in range(invlists.nlist)
+            if invlists.list_size(i) > 0
+        ]
+    )
+
+
+def remove_index_ids(
+    index: faiss.Index, ids: np.ndarray, store: EmbeddingStore
+) -> faiss.Index:
+    """
+    Remove the embeddings of the given ids from the index, returns the updated index
+    """
+    if get_index_type(index) == "hnsw":
+        # HNSW graphs don't support removal, so rebuild the index without the ids
+        keep_ids = np.setdiff1d(get_index_ids(index), ids)
+        return migrate_index(index, store, "hnsw", keep_ids)
+
+    index.remove_ids(np.asarray(ids, dtype=np.int64))
+    return index
+
+
+def reconcile_index(
+    conn, index: faiss.Index, store: EmbeddingStore
+) -> tuple[faiss.Index, bool]:
+    """
+    Make the index match the faces table after an interrupted run, by adding the stored
+    embeddings of faces missing from the index and removing ids of faces that don't exist.
+    Returns the updated index and whether it was changed.
+    """
+    face_ids = np.array(
+        conn.execute(select(faces_table.c.id)).scalars().all(), dtype=np.int64
+    )
+    index_ids = get_index_ids(index)
+
+    missing_ids = np.setdiff1d(face_ids, index_ids)
+    unknown_ids = np.setdiff1d(index_ids, face_ids)
+
+    for start in range(0, len(missing_ids), RECONCILE_BATCH_SIZE):
+        batch = missing_ids[start : start + RECONCILE_BATCH_SIZE].tolist()
+        rows = conn.execute(
+            select(faces_table.c.id, faces_table.c.embedding).where(
+                faces_table.c.id.in_(batch)
+            )
+        ).all()
+        embeddings = np.stack([decode_embedding(row.embedding, index.d) for row in rows])
+        index.add_with_ids(embeddings, np.array([row.id for row in rows], dtype=np.int64))
+
+    if len(unknown_ids) > 0:
+        index = remove_index_ids(index, unknown_ids, store)
+
+    if len(missing_ids) > 0 or len(unknown_ids) > 0:
+        print(
+            f"Reconciled embeddings index: added {len(missing_ids)} missing "
+            f"and removed {len(unknown_ids)} unknown faces"
+        )
+        return index, True
+
+    return index, False
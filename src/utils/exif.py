@@ -0,0 +1,125 @@
+"""Helpers to read and write XMP tags through long-lived ExifTool processes"""
+
+import os
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+
+from exiftool import ExifToolHelper
+from exiftool.exceptions import ExifToolExecuteError
+
+# Number of files passed to a single ExifTool call
+EXIF_BATCH_SIZE = 250
+# Number of ExifTool processes writing tags in parallel, each rewrites whole files so
+# more processes mostly help on fast storage
+EXIF_WRITE_WORKERS = int(os.environ.get("EXIF_WRITE_WORKERS", 2))
+
+
+def normalize_subject(value) -> list[str]:
+    """
+    ExifTool returns a single Subject as a string and multiple as a list, normalize both
+    """
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return [str(v) for v in value]
+    return [str(value)]
+
+
+def read_subject_tags(
+    et: ExifToolHelper, filepaths: list[str], batch_size: int = EXIF_BATCH_SIZE
+) -> dict[str, list[str]]:
+    """
+    Read the XMP Subject tag of many files using an already running ExifTool
+    process in -stay_open mode, querying a batch of files per call
+    """
+    subjects = {}
+    for start in range(0, len(filepaths), batch_size):
+        batch = filepaths[start : start + batch_size]
+        try:
+            results = et.get_tags(batch, tags=["Subject"])
+        except ExifToolExecuteError:
+            # A single unreadable file fails the whole batch, so retry one by one
+            results = []
+            for filepath in batch:
+                try:
+                    results.extend(et.get_tags(filepath, tags=["Subject"]))
+                except ExifToolExecuteError as error:
+                    print(f"Failed to read tags of {filepath}: {error}")
+
+        for result in results:
+            subjects[result["SourceFile"]] = normalize_subject(
+                result.get("XMP:Subject")
+            )
+
+    return subjects
+
+
+def write_subject_tags(
+    et: ExifToolHelper,
+    filepaths: list[str],
+    subject: list[str],
+    params: list[str] | None = None,
+) -> list[str]:
+    """
+    Write the same XMP Subject tag to many files in a single ExifTool call, an empty
+    subject removes the tag. Extra ExifTool parameters are passed along, e.g.
+    -overwrite_original. Returns the files that were written.
+    """
+    # ExifTool removes a tag that is assigned an empty value
+    subject = subject or ""
+    try:
+        et.set_tags(filepaths, tags={"Subject": subject}, params=params)
+        return filepaths
+    except ExifToolExecuteError:
+        # A single unwritable file fails the whole batch, so retry one by one
+        written = []
+        for filepath in filepaths:
+            try:
+                et.set_tags(filepath, tags={"Subject": subject}, params=params)
+                written.append(filepath)
+            except ExifToolExecuteError as error:
+                print(f"Failed to write tags of {filepath}: {error}")
+        return written
+
+
+def write_subject_tags_parallel(
+    subjects: dict[tuple[str, ...], list[str]],
+    workers: int = EXIF_WRITE_WORKERS,
+    batch_size: int = EXIF_BATCH_SIZE,
+    params: list[str] | None = None,
+) -> dict[str, list[str]]:
+    """
+    Write the XMP Subject tag of many files grouped by identical subject, so every ExifTool
+    call writes a batch of files, using a pool of ExifTool processes in -stay_open mode.
+    Returns the subject written to every file.
+    """
+    jobs = [
+        (list(subject), filepaths[start : start + batch_size])
+        for subject, filepaths in subjects.items()
+        for start in range(0, len(filepaths), batch_size)
+    ]
+    if not jobs:
+        return {}
+
+    workers = max(1, min(workers, len(jobs)))
+    with ExitStack() as stack:
+        # Every job borrows an idle ExifTool process and returns it when done
+        idle = queue.Queue()
+        for _ in range(workers):
+            idle.put(stack.enter_context(ExifToolHelper()))
+
+        def run(job: tuple[list[str], list[str]]) -> tuple[list[str], list[str]]:
+            subject, filepaths = job
+            et = idle.get()
+            try:
+                return subject, write_subject_tags(et, filepaths, subject, params)
+            finally:
+                idle.put(et)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return {
+                filepath: subject
+                for subject, written in executor.map(run, jobs)
+                for filepath in written
+            }
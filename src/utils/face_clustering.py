@@ -0,0 +1,138 @@
+"""Batch clustering of unlabeled faces into likely persons using a nearest neighbor graph"""
+
+import uuid
+from collections import Counter
+
+import numpy as np
+from sqlalchemy import select
+
+from .person_lookup import UNLABELED, get_face_persons
+from .tables import clusters as clusters_table
+
+# Number of face ids per IN clause when removing cluster assignments
+CLUSTER_DELETE_BATCH_SIZE = 500
+
+
+def find_neighbor_edges(
+    face_ids: np.ndarray,
+    distances: np.ndarray,
+    indices: np.ndarray,
+    face_persons: np.ndarray,
+    threshold: float,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Get the edges of the neighbor graph from the raw (n, k) search results of a batch of faces,
+    connecting every face to its unlabeled neighbors within the distance threshold
+    """
+    sources = np.broadcast_to(face_ids[:, None], indices.shape)
+    relevant = (
+        (indices >= 0)
+        & (indices != sources)
+        & (distances <= threshold)
+        & (get_face_persons(face_persons, indices) == UNLABELED)
+    )
+    return sources[relevant], indices[relevant]
+
+
+def find_components(size: int, sources: np.ndarray, targets: np.ndarray) -> np.ndarray:
+    """
+    Union-find over all edges at once: returns for every node the smallest node of its
+    connected component. Roots are hooked onto the smaller root of every edge and the
+    trees are flattened by pointer jumping until no edge connects two different roots.
+    """
+    roots = np.arange(size, dtype=np.int64)
+    while True:
+        source_roots, target_roots = roots[sources], roots[targets]
+        if np.array_equal(source_roots, target_roots):
+            return roots
+
+        lowest_roots = np.minimum(source_roots, target_roots)
+        np.minimum.at(roots, source_roots, lowest_roots)
+        np.minimum.at(roots, target_roots, lowest_roots)
+
+        # Every node points to a smaller node, so jumping ends at the root
+        while True:
+            jumped = roots[roots]
+            if np.array_equal(jumped, roots):
+                break
+            roots = jumped
+
+
+def update_clusters(
+    conn, face_ids: np.ndarray, sources: np.ndarray, targets: np.ndarray
+) -> int:
+    """
+    Cluster the given unlabeled faces using the edges of their neighbor graph, together with
+    the existing clusters so new faces join or merge them. A cluster keeps the id most of its
+    faces already had. Only changed assignments are written, in a single transaction.
+    Returns the number of clusters.
+    """
+    face_ids = np.unique(face_ids)
+
+    # Existing assignments, faces that got labeled or removed in the meantime are dropped below
+    existing = {}
+    duplicated = set()
+    for row in conn.execute(select(clusters_table.c.face_id, clusters_table.c.cluster_id)):
+        if row.face_id in existing:
+            duplicated.add(row.face_id)
+        existing[row.face_id] = row.cluster_id
+
+    # Seed the graph with the existing clusters by linking their faces to the first face
+    unlabeled = set(face_ids.tolist())
+    first_faces = {}
+    seed_sources, seed_targets = [], []
+    for face_id, cluster_id in existing.items():
+        if face_id not in unlabeled:
+            continue
+        first_face = first_faces.setdefault(cluster_id, face_id)
+        if first_face != face_id:
+            seed_sources.append(first_face)
+            seed_targets.append(face_id)
+
+    edge_sources = np.concatenate([sources, np.array(seed_sources, dtype=np.int64)])
+    edge_targets = np.concatenate([targets, np.array(seed_targets, dtype=np.int64)])
+    edges_known = np.isin(edge_sources, face_ids) & np.isin(edge_targets, face_ids)
+    roots = find_components(
+        len(face_ids),
+        np.searchsorted(face_ids, edge_sources[edges_known]),
+        np.searchsorted(face_ids, edge_targets[edges_known]),
+    )
+
+    # Assign a cluster id to every component of more than one face
+    assignments = {}
+    order = np.argsort(roots, kind="stable")
+    components = np.split(order, np.flatnonzero(np.diff(roots[order])) + 1)
+    for members in components:
+        if len(members) < 2:
+            continue
+
+        member_ids = face_ids[members].tolist()
+        previous = Counter(existing[face_id] for face_id in member_ids if face_id in existing)
+        cluster_id = previous.most_common(1)[0][0] if previous else uuid.uuid4()
+        for face_id in member_ids:
+            assignments[face_id] = cluster_id
+
+    # Only rewrite the faces whose assignment changed
+    changed = [
+        face_id
+        for face_id in set(existing) | set(assignments)
+        if face_id in duplicated or existing.get(face_id) != assignments.get(face_id)
+    ]
+    for start in range(0, len(changed), CLUSTER_DELETE_BATCH_SIZE):
+        conn.execute(
+            clusters_table.delete().where(
+                clusters_table.c.face_id.in_(changed[start : start + CLUSTER_DELETE_BATCH_SIZE])
+            )
+        )
+
+    values = [
+        {"face_id": face_id, "cluster_id": assignments[face_id]}
+        for face_id in changed
+        if face_id in assignments
+    ]
+    if values:
+        conn.execute(clusters_table.insert(), values)
+    conn.commit()
+
+    print(f"Clustered unknown faces: {len(values)} assignments changed")
+    return len(set(assignments.values()))
@@ -0,0 +1,194 @@
+"""Helpers to remove deleted files and outdated faces from the database and thumbnails folder"""
+
+import os
+
+from sqlalchemy import and_, or_, select
+
+from .tables import clusters as clusters_table
+from .tables import detection_stages as detection_stages_table
+from .tables import face_neighbors as face_neighbors_table
+from .tables import faces as faces_table
+from .tables import files as files_table
+from .tables import label_changes as label_changes_table
+from .tables import manifest as manifest_table
+
+# Number of ids or paths per IN clause, well below the maximum number of SQLite query parameters
+GARBAGE_BATCH_SIZE = 500
+
+
+def chunks(values: list, size: int = GARBAGE_BATCH_SIZE):
+    """
+    Split a list in chunks of the given size
+    """
+    return (values[i : i + size] for i in range(0, len(values), size))
+
+
+def delete_faces(conn, face_ids: list[int]) -> tuple[set[str], set[int]]:
+    """
+    Delete faces and all rows referring to them, returns the thumbnail filenames
+    and the persons of the deleted faces
+    """
+    thumbnails, person_ids = set(), set()
+    for batch in chunks(face_ids):
+        statement = select(faces_table.c.thumbnail_filename, faces_table.c.person_id).where(
+            faces_table.c.id.in_(batch)
+        )
+        for row in conn.execute(statement):
+            if row.thumbnail_filename:
+                thumbnails.add(row.thumbnail_filename)
+            if row.person_id:
+                person_ids.add(row.person_id)
+
+        conn.execute(clusters_table.delete().where(clusters_table.c.face_id.in_(batch)))
+        conn.execute(
+            face_neighbors_table.delete().where(face_neighbors_table.c.face_id.in_(batch))
+        )
+        conn.execute(
+            label_changes_table.delete().where(label_changes_table.c.face_id.in_(batch))
+        )
+        conn.execute(faces_table.delete().where(faces_table.c.id.in_(batch)))
+
+    return thumbnails, person_ids
+
+
+def find_files_below(conn, paths: list[str]) -> list[tuple[int, str]]:
+    """
+    Find the id and path of the files at the given paths, or below them when a path is a directory
+    """
+    conditions = []
+    for path in paths:
+        # Range instead of LIKE, so the unique index on the path is used
+        prefix = path.rstrip(os.sep) + os.sep
+        upper_bound = prefix[:-1] + chr(ord(os.sep) + 1)
+        conditions.append(files_table.c.path == path)
+        conditions.append(and_(files_table.c.path >= prefix, files_table.c.path < upper_bound))
+
+    files = []
+    for batch in chunks(conditions, GARBAGE_BATCH_SIZE // 2):
+        statement = select(files_table.c.id, files_table.c.path).where(or_(*batch))
+        files.extend((row.id, row.path) for row in conn.execute(statement))
+    return files
+
+
+def delete_files(conn, paths: list[str]) -> tuple[list[int], set[str], set[int]]:
+    """
+    Delete the files at or below the given paths with their faces, returns the ids of the
+    deleted faces, the thumbnail filenames of the deleted faces and files, and their persons
+    """
+    files = find_files_below(conn, paths)
+    file_ids = [file_id for file_id, _ in files]
+
+    face_ids = []
+    file_thumbnails = set()
+    for batch in chunks(file_ids):
+        face_ids.extend(
+            conn.execute(
+                select(faces_table.c.id).where(faces_table.c.file_id.in_(batch))
+            ).scalars()
+        )
+        file_thumbnails.update(
+            filename
+            for filename in conn.execute(
+                select(files_table.c.thumbnail_filename).where(files_table.c.id.in_(batch))
+            ).scalars()
+            if filename
+        )
+
+    thumbnails, person_ids = delete_faces(conn, face_ids)
+
+    for batch in chunks(files):
+        batch_ids = [file_id for file_id, _ in batch]
+        conn.execute(
+            detection_stages_table.delete().where(
+                detection_stages_table.c.file_id.in_(batch_ids)
+            )
+        )
+        conn.execute(
+            manifest_table.delete().where(
+                manifest_table.c.path.in_([path for _, path in batch])
+            )
+        )
+        conn.execute(files_table.delete().where(files_table.c.id.in_(batch_ids)))
+
+    if files:
+        print(f"Deleted {len(files)} removed files with {len(face_ids)} faces")
+
+    return face_ids, thumbnails | file_thumbnails, person_ids
+
+
+def clear_outdated_files(
+    conn, file_ids: list[int] | None = None
+) -> tuple[list[int], set[str], set[int]]:
+    """
+    Delete the faces and file thumbnail of modified files, or only the given files, that are
+    pending face detection again but still hold the results of their previous content.
+    Returns the ids of the deleted faces, the outdated thumbnail filenames and their persons.
+    """
+    statement = select(files_table.c.id, files_table.c.thumbnail_filename).where(
+        files_table.c.contains_face.is_(None)
+    )
+    if file_ids is None:
+        statements = [statement]
+    else:
+        statements = [statement.where(files_table.c.id.in_(batch)) for batch in chunks(file_ids)]
+
+    pending = [row for statement in statements for row in conn.execute(statement)]
+
+    face_ids = []
+    for batch in chunks([row.id for row in pending]):
+        face_ids.extend(
+            conn.execute(
+                select(faces_table.c.id).where(faces_table.c.file_id.in_(batch))
+            ).scalars()
+        )
+
+    thumbnails, person_ids = delete_faces(conn, face_ids)
+
+    outdated_files = [row for row in pending if row.thumbnail_filename]
+    for batch in chunks([row.id for row in outdated_files]):
+        conn.execute(
+            files_table.update()
+            .where(files_table.c.id.in_(batch))
+            .values(thumbnail_filename=None)
+        )
+    thumbnails.update(row.thumbnail_filename for row in outdated_files)
+
+    if face_ids or outdated_files:
+        print(
+            f"Cleared {len(face_ids)} outdated faces and "
+            f"{len(outdated_files)} outdated file thumbnails of modified files"
+        )
+
+    return face_ids, thumbnails, person_ids
+
+
+def remove_orphaned_thumbnails(conn, filenames: set[str], thumbnails_path: str) -> int:
+    """
+    Delete the thumbnails no face or file refers to anymore, copies of a file share their
+    thumbnails so they can only be removed once the last copy is gone. Returns the number
+    of removed thumbnails.
+    """
+    removed = 0
+    for batch in chunks(sorted(filenames)):
+        referenced = set(
+            conn.execute(
+                select(faces_table.c.thumbnail_filename).where(
+                    faces_table.c.thumbnail_filename.in_(batch)
+                )
+            ).scalars()
+        )
+        referenced.update(
+            conn.execute(
+                select(files_table.c.thumbnail_filename).where(
+                    files_table.c.thumbnail_filename.in_(batch)
+                )
+            ).scalars()
+        )
+
+        for filename in batch:
+            path = os.path.join(thumbnails_path, filename)
+            if filename not in referenced and os.path.exists(path):
+                os.remove(path)
+                removed += 1
+
+    return removed
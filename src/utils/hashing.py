@@ -0,0 +1,121 @@
+"""Parallel hashing engine to calculate the content hash of many files at once"""
+
+import hashlib
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+# Size of the reusable buffer each worker reads into when hashlib.file_digest is not available
+HASH_BUFFER_SIZE = 4 * 1024 * 1024
+# Worker counts per storage type, spinning disks suffer from too many concurrent seeks
+HASH_WORKERS_ROTATIONAL = 2
+HASH_WORKERS_SOLID_STATE = min(32, (os.cpu_count() or 1) * 2)
+HASH_WORKERS_UNKNOWN = 4  # E.g. network shares, where the storage type can't be detected
+
+
+def hash_file(filepath: str) -> str:
+    """
+    Calculate the SHA-256 hash of a file without copying its contents more than needed
+    """
+    with open(filepath, "rb") as f:
+        # file_digest reads straight into the hash object (Python 3.11+)
+        if hasattr(hashlib, "file_digest"):
+            return hashlib.file_digest(f, "sha256").hexdigest()
+
+        file_hash = hashlib.sha256()
+        buffer = bytearray(HASH_BUFFER_SIZE)
+        view = memoryview(buffer)
+        while size := f.readinto(buffer):
+            file_hash.update(view[:size])
+
+    return file_hash.hexdigest()
+
+
+def get_stat_signature(filepath: str) -> tuple[int, int, int, int]:
+    """
+    Get the stat signature (size, mtime_ns, inode, device) of a file, which changes
+    whenever the file is modified or replaced
+    """
+    stat = os.stat(filepath)
+    return (stat.st_size, stat.st_mtime_ns, stat.st_ino, stat.st_dev)
+
+
+def is_rotational_storage(path: str) -> bool | None:
+    """
+    Detect whether the block device holding the path is a spinning disk,
+    returns None when it can't be detected (e.g. non-Linux systems or network shares)
+    """
+    device = os.stat(path).st_dev
+    sys_path = f"/sys/dev/block/{os.major(device)}:{os.minor(device)}"
+
+    # Partitions don't have a queue themselves, so fall back to their parent device
+    for queue_path in (
+        os.path.join(sys_path, "queue", "rotational"),
+        os.path.join(sys_path, "..", "queue", "rotational"),
+    ):
+        try:
+            with open(queue_path, encoding="ascii") as f:
+                return f.read().strip() == "1"
+        except OSError:
+            continue
+
+    return None
+
+
+def get_hash_workers(path: str) -> int:
+    """
+    Get the number of hashing workers, either configured through the HASH_WORKERS
+    environment variable or adapted to the storage type of the path
+    """
+    if os.environ.get("HASH_WORKERS"):
+        return max(1, int(os.environ["HASH_WORKERS"]))
+
+    rotational = is_rotational_storage(path)
+    if rotational is None:
+        return HASH_WORKERS_UNKNOWN
+    return HASH_WORKERS_ROTATIONAL if rotational else HASH_WORKERS_SOLID_STATE
+
+
+def hash_files(
+    filepaths: list[str],
+    workers: int,
+    executor: ThreadPoolExecutor | None = None,
+    report: bool = True,
+) -> dict[str, str]:
+    """
+    Calculate the SHA-256 hash of many files concurrently using a bounded thread pool
+    and report the throughput. An already running pool can be passed in when hashing
+    many small batches. Files that can't be read are left out of the result.
+    """
+    hashes = {}
+    total_bytes = 0
+    start = time.perf_counter()
+
+    def hash_with_size(filepath: str) -> tuple[str, str | None, int]:
+        try:
+            return filepath, hash_file(filepath), os.path.getsize(filepath)
+        except OSError as error:
+            print(f"Failed to hash {filepath}: {error}")
+            return filepath, None, 0
+
+    # Hashing releases the GIL, so threads are enough to keep multiple disks busy
+    if executor is None:
+        executor = ThreadPoolExecutor(max_workers=workers)
+    else:
+        executor = nullcontext(executor)  # Owned by the caller, so it isn't shut down here
+    with executor as pool:
+        for filepath, file_hash, size in pool.map(hash_with_size, filepaths):
+            if file_hash is not None:
+                hashes[filepath] = file_hash
+                total_bytes += size
+
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    if hashes and report:
+        print(
+            f"Hashed {len(hashes)} files ({total_bytes / 1e6:.1f} MB) with {workers} workers "
+            f"in {elapsed:.1f}s: {total_bytes / 1e6 / elapsed:.1f} MB/s, "
+            f"{len(hashes) / elapsed:.1f} files/s"
+        )
+
+    return hashes
@@ -0,0 +1,35 @@
+"""Helpers to decode images at reduced resolution"""
+
+import numpy as np
+from PIL import Image, ImageOps
+
+
+def load_image(filepath: str, max_side: int | None = None) -> tuple[Image.Image, float]:
+    """
+    Decode an image transposed according to its EXIF Orientation tag, with its longest side
+    reduced to about max_side. JPEGs are decoded at reduced size directly using DCT scaling.
+    Returns the image and the factor to map its coordinates back to the original resolution.
+    """
+    with Image.open(filepath) as image:
+        original_width = image.width
+
+        if max_side and max(image.size) > max_side:
+            ratio = max_side / max(image.size)
+            # Draft mode picks the smallest DCT scale that is at least the requested size
+            image.draft("RGB", (int(image.width * ratio), int(image.height * ratio)))
+            image.thumbnail((max_side, max_side))
+
+        scale = original_width / image.width
+
+        # Transpose the image according to its EXIF Orientation tag
+        image = ImageOps.exif_transpose(image)
+        image.load()
+
+        return image, scale
+
+
+def to_bgr_array(image: Image.Image) -> np.ndarray:
+    """
+    Convert an image to a BGR numpy array as used by OpenCV based libraries like Deepface
+    """
+    return np.array(image.convert("RGB"))[:, :, ::-1]
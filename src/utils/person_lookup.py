@@ -0,0 +1,36 @@
+"""Dense in-memory lookup table from face id to person id"""
+
+import numpy as np
+from sqlalchemy import select
+
+from .tables import faces as faces_table
+
+UNLABELED = -1  # Face exists, but is not linked to a person yet
+NO_FACE = -2  # No face exists with this id
+
+
+def load_face_persons(conn) -> np.ndarray:
+    """
+    Load the person id of every face in a single query into an array indexed by face id
+    """
+    rows = conn.execute(select(faces_table.c.id, faces_table.c.person_id)).all()
+    face_ids = np.array([row.id for row in rows], dtype=np.int64)
+    person_ids = np.array(
+        [UNLABELED if row.person_id is None else row.person_id for row in rows],
+        dtype=np.int64,
+    )
+
+    lookup = np.full(int(face_ids.max()) + 1 if len(rows) else 0, NO_FACE, dtype=np.int64)
+    lookup[face_ids] = person_ids
+    return lookup
+
+
+def get_face_persons(lookup: np.ndarray, face_ids: np.ndarray) -> np.ndarray:
+    """
+    Get the person ids of an array of face ids, where ids of -1 or unknown faces map to NO_FACE
+    """
+    if len(lookup) == 0:
+        return np.full(face_ids.shape, NO_FACE, dtype=np.int64)
+
+    in_range = (face_ids >= 0) & (face_ids < len(lookup))
+    return np.where(in_range, lookup[np.where(in_range, face_ids, 0)], NO_FACE)
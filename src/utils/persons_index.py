@@ -0,0 +1,202 @@
+"""Small Faiss index holding a few prototype embeddings per known person"""
+
+import fcntl
+import os
+from collections import defaultdict
+from collections.abc import Iterator
+from contextlib import contextmanager
+
+import faiss
+import numpy as np
+from sqlalchemy import select
+
+from .embedding_codec import EMBEDDING_METRIC, decode_embedding, prepare_embeddings
+from .embedding_store import EmbeddingStore, get_embeddings, is_stored
+from .embeddings_index import read_index, search_index, write_index
+from .tables import faces as faces_table
+
+# Number of medoids stored per person next to the mean of all its faces
+PERSON_MEDOIDS = 3
+PROTOTYPES_PER_PERSON = 1 + PERSON_MEDOIDS
+# Maximum number of faces of a person the medoids are chosen from
+PERSON_MEDOIDS_SAMPLE_SIZE = 1000
+# Maximum number of iterations to improve the medoids
+PERSON_MEDOIDS_ITERATIONS = 10
+
+
+@contextmanager
+def lock_persons_index(path: str) -> Iterator[None]:
+    """
+    Serialize read-modify-write cycles of the persons index file between the threads and
+    processes updating it, e.g. the web interface and the embedding flow, through an
+    exclusive lock on a file next to it
+    """
+    with open(path + ".lock", "wb") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def compute_prototypes(embeddings: np.ndarray) -> np.ndarray:
+    """
+    Compute the prototypes of a person: the mean of all its face embeddings plus
+    up to PERSON_MEDOIDS medoids, so persons that look different between photos
+    (e.g. with and without glasses) are still represented well
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    mean = embeddings.mean(axis=0, keepdims=True)
+    if len(embeddings) == 1:
+        return prepare_embeddings(mean)
+
+    if len(embeddings) > PERSON_MEDOIDS_SAMPLE_SIZE:
+        rng = np.random.default_rng(0)
+        embeddings = embeddings[
+            rng.choice(len(embeddings), PERSON_MEDOIDS_SAMPLE_SIZE, replace=False)
+        ]
+
+    squared_norms = (embeddings**2).sum(axis=1)
+    distances = squared_norms[:, None] + squared_norms[None, :] - 2 * embeddings @ embeddings.T
+
+    # Start at the face closest to the mean, then add the faces farthest from the chosen ones
+    medoids = [int(((embeddings - mean) ** 2).sum(axis=1).argmin())]
+    while len(medoids) < min(PERSON_MEDOIDS, len(embeddings)):
+        medoids.append(int(distances[:, medoids].min(axis=1).argmax()))
+
+    # Move every medoid to the face with the lowest total distance within its cluster
+    for _ in range(PERSON_MEDOIDS_ITERATIONS):
+        assignments = distances[:, medoids].argmin(axis=1)
+        new_medoids = []
+        for cluster in range(len(medoids)):
+            members = np.flatnonzero(assignments == cluster)
+            within = distances[np.ix_(members, members)].sum(axis=1)
+            new_medoids.append(int(members[within.argmin()]))
+        if new_medoids == medoids:
+            break
+        medoids = new_medoids
+
+    # The mean of normalized embeddings is normalized again for the cosine metric
+    return prepare_embeddings(np.vstack([mean, embeddings[medoids]]))
+
+
+def create_persons_index(dimension: int) -> faiss.Index:
+    """
+    Create an empty persons index, the ids of the prototypes of a person
+    are person_id * PROTOTYPES_PER_PERSON + prototype number
+    """
+    if EMBEDDING_METRIC == "cosine":
+        return faiss.IndexIDMap2(faiss.IndexFlatIP(dimension))
+    return faiss.IndexIDMap2(faiss.IndexFlatL2(dimension))
+
+
+def update_person(index: faiss.Index, person_id: int, embeddings: np.ndarray):
+    """
+    Replace the prototypes of a person by those of the given face embeddings,
+    which removes the person when there are no embeddings
+    """
+    first_id = person_id * PROTOTYPES_PER_PERSON
+    index.remove_ids(faiss.IDSelectorRange(first_id, first_id + PROTOTYPES_PER_PERSON))
+
+    if len(embeddings) > 0:
+        prototypes = compute_prototypes(embeddings)
+        index.add_with_ids(
+            prototypes, np.arange(first_id, first_id + len(prototypes), dtype=np.int64)
+        )
+
+
+def build_persons_index(conn, store: EmbeddingStore, dimension: int) -> faiss.Index:
+    """
+    Build the persons index from all faces that are labeled with a person
+    """
+    # The 'Ignored' person with id 0 is never suggested
+    statement = select(faces_table.c.id, faces_table.c.person_id).where(
+        faces_table.c.person_id > 0
+    )
+    faces_by_person = defaultdict(list)
+    for row in conn.execute(statement):
+        faces_by_person[row.person_id].append(row.id)
+
+    store_rows, embeddings = store.load_rows()
+    index = create_persons_index(dimension)
+    for person_id, face_ids in faces_by_person.items():
+        face_ids = np.array(face_ids, dtype=np.int64)
+        stored = is_stored(store_rows, face_ids)
+
+        # Faces are committed before the store is synced, so recent faces may be missing
+        person_embeddings = get_embeddings(store_rows, embeddings, face_ids[stored])
+        if not stored.all():
+            person_embeddings = np.vstack(
+                [
+                    person_embeddings,
+                    load_face_embeddings(conn, face_ids[~stored].tolist(), dimension),
+                ]
+            )
+        update_person(index, person_id, person_embeddings)
+
+    return index
+
+
+def load_face_embeddings(conn, face_ids: list[int], dimension: int) -> np.ndarray:
+    """
+    Load the embeddings of the given faces from the database
+    """
+    embeddings = []
+    for start in range(0, len(face_ids), 500):
+        statement = select(faces_table.c.embedding).where(
+            faces_table.c.id.in_(face_ids[start : start + 500])
+        )
+        embeddings.extend(
+            decode_embedding(embedding, dimension)
+            for embedding in conn.execute(statement).scalars()
+        )
+    return np.array(embeddings, dtype=np.float32).reshape(-1, dimension)
+
+
+def load_person_embeddings(conn, person_id: int, dimension: int) -> np.ndarray:
+    """
+    Load the embeddings of all faces labeled with a person from the database
+    """
+    statement = select(faces_table.c.embedding).where(faces_table.c.person_id == person_id)
+    embeddings = [
+        decode_embedding(embedding, dimension)
+        for embedding in conn.execute(statement).scalars()
+    ]
+    return np.array(embeddings, dtype=np.float32).reshape(-1, dimension)
+
+
+def refresh_persons(conn, person_ids: list[int | None]):
+    """
+    Recompute the prototypes of the given persons in the persons index on disk after their
+    faces changed. Skipped when the index doesn't exist yet, as it's built from all labels then.
+    """
+    path = os.environ["PERSONS_INDEX_PATH"]
+    person_ids = {person_id for person_id in person_ids if person_id}
+    if not person_ids:
+        return
+
+    with lock_persons_index(path):
+        if not os.path.exists(path):
+            return
+
+        index = read_index(path)
+        for person_id in person_ids:
+            update_person(index, person_id, load_person_embeddings(conn, person_id, index.d))
+        write_index(index, path)
+
+
+def search_persons(
+    index: faiss.Index, embeddings: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Find the closest known person of a batch of embeddings, returns their squared L2 distance
+    to its closest prototype and the person id, which is -1 when there are no persons
+    """
+    if index.ntotal == 0:
+        return (
+            np.full(len(embeddings), np.inf, dtype=np.float32),
+            np.full(len(embeddings), -1, dtype=np.int64),
+        )
+
+    distances, ids = search_index(index, embeddings, 1)
+    return distances[:, 0], np.where(ids[:, 0] >= 0, ids[:, 0] // PROTOTYPES_PER_PERSON, -1)
@@ -0,0 +1,35 @@
+"""Named counters and high-water marks of incremental processing"""
+
+from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert
+
+from .tables import processing_state as processing_state_table
+
+# Highest label change id processed by recognition
+RECOGNITION_LABEL_HIGH_WATER_MARK = "recognition_label_high_water_mark"
+# Index generation all evaluated faces were searched in
+RECOGNITION_INDEX_GENERATION = "recognition_index_generation"
+# Incremented whenever the embeddings index is rebuilt, which can change search results
+INDEX_GENERATION = "index_generation"
+
+
+def get_state(conn, name: str, default: int = 0) -> int:
+    """
+    Get the value of a named state, or the default when it was never set
+    """
+    value = conn.execute(
+        select(processing_state_table.c.value).where(processing_state_table.c.name == name)
+    ).scalar()
+    return default if value is None else value
+
+
+def set_state(conn, name: str, value: int):
+    """
+    Set the value of a named state, committed together with the caller's transaction
+    """
+    statement = insert(processing_state_table).values(name=name, value=value)
+    conn.execute(
+        statement.on_conflict_do_update(
+            index_elements=["name"], set_={"value": statement.excluded.value}
+        )
+    )
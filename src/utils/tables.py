@@ -7,6 +7,7 @@ from sqlalchemy import (
     Float,
     ForeignKey,
     Integer,
+    JSON,
     LargeBinary,
     MetaData,
     String,
@@ -21,26 +22,65 @@ files = Table(
     meta,
     Column("id", Integer, primary_key=True),
     Column("path", String, unique=True, nullable=False),
-    Column("thumbnail_filename", String),
+    Column("thumbnail_filename", String, index=True),
     Column("hash", String(length=64), nullable=False),
     Column("last_updated", DateTime, nullable=False),
-    Column("contains_face", Boolean),
+    Column("contains_face", Boolean, index=True),
+    Column("subject_tags", JSON),
+    # Person names write_tags last wrote to the XMP sidecar of the file
+    Column("sidecar_tags", JSON),
+)
+
+# Stat signature of every file at the time it was last hashed, so unchanged
+# files can be skipped without reading their contents again
+manifest = Table(
+    "manifest",
+    meta,
+    Column("path", ForeignKey("files.path"), primary_key=True),
+    Column("size", Integer, nullable=False),
+    Column("mtime_ns", Integer, nullable=False),
+    Column("inode", Integer, nullable=False),
+    Column("device", Integer, nullable=False),
+)
+
+# Modification time and subdirectories of every directory in the library at the
+# time it was last listed, so directories without added/removed entries can be skipped
+directories = Table(
+    "directories",
+    meta,
+    Column("path", String, primary_key=True),
+    Column("mtime_ns", Integer, nullable=False),
+    Column("subdirectories", JSON, nullable=False),
 )
 
 faces = Table(
     "faces",
     meta,
     Column("id", Integer, primary_key=True),
-    Column("file_id", ForeignKey("files.id"), nullable=False),
+    Column("file_id", ForeignKey("files.id"), nullable=False, index=True),
     Column("person_id", ForeignKey("persons.id")),
     Column("person_id_suggested", ForeignKey("persons.id")),
-    Column("thumbnail_filename", String),
+    Column("thumbnail_filename", String, index=True),
     Column("embedding", LargeBinary, nullable=False),
     Column("confidence", Float, nullable=False),
     Column("facial_area_top", Integer, nullable=False),
     Column("facial_area_left", Integer, nullable=False),
     Column("facial_area_width", Integer, nullable=False),
     Column("facial_area_height", Integer, nullable=False),
+    # Set once recognition evaluated the face, as SQLite reuses the ids of deleted faces
+    # so new faces can't be told apart by their id
+    Column("evaluated", Boolean),
+)
+
+# Outcome of the detection cascade stages per file, used to tune the screening thresholds
+detection_stages = Table(
+    "detection_stages",
+    meta,
+    Column("file_id", ForeignKey("files.id"), primary_key=True),
+    Column("screening_model", String, nullable=False),
+    Column("screening_faces", Integer, nullable=False),
+    Column("screening_max_confidence", Float, nullable=False),
+    Column("detection_faces", Integer),  # Empty when the file was not passed on
 )
 
 persons = Table(
@@ -50,6 +90,33 @@ persons = Table(
     Column("name", String, unique=True),
 )
 
+# Faces labeled through the web interface since recognition last ran, so only faces
+# with such a face among their nearest neighbors have to be evaluated again
+label_changes = Table(
+    "label_changes",
+    meta,
+    Column("id", Integer, primary_key=True),
+    Column("face_id", ForeignKey("faces.id"), nullable=False),
+    # Never reuse ids of processed changes, as recognition tracks the last processed id
+    sqlite_autoincrement=True,
+)
+
+# Nearest neighbors of every unlabeled face when recognition last evaluated it
+face_neighbors = Table(
+    "face_neighbors",
+    meta,
+    Column("face_id", ForeignKey("faces.id"), primary_key=True),
+    Column("neighbor_id", Integer, primary_key=True, index=True),
+)
+
+# Counters and high-water marks of incremental processing, stored by name
+processing_state = Table(
+    "processing_state",
+    meta,
+    Column("name", String, primary_key=True),
+    Column("value", Integer, nullable=False),
+)
+
 clusters = Table(
     "clusters",
     meta,
@@ -0,0 +1,236 @@
+"""Renders thumbnails on demand into a size-bounded, content-addressed disk cache"""
+
+import hashlib
+import io
+import os
+import tempfile
+import threading
+from collections.abc import Callable
+
+from PIL import Image, features
+
+from .images import load_image
+
+# "eager" pre-renders all thumbnails in the pipeline, "lazy" only renders them when requested
+THUMBNAIL_MODE = os.environ.get("THUMBNAIL_MODE", "eager")
+# Maximum total size of the rendered thumbnails on disk, least recently used ones are evicted
+THUMBNAIL_CACHE_BYTES = int(os.environ.get("THUMBNAIL_CACHE_BYTES", 1024**3))
+# Fraction of the budget the cache is shrunk to when evicting, so it isn't scanned on every render
+THUMBNAIL_CACHE_LOW_WATERMARK = 0.9
+# Requested widths are rounded up to one of these, so every thumbnail has few cached variants
+THUMBNAIL_WIDTHS = (80, 160, 320, 500, 1000)
+MAX_THUMBNAIL_WIDTHS = {"face": 500, "file": 1000}
+# Output formats by name with their Pillow format, media type and encoder options
+THUMBNAIL_FORMATS = {
+    "webp": ("WEBP", "image/webp", {"quality": 80, "method": 4}),
+    "jpeg": ("JPEG", "image/jpeg", {"quality": 85, "optimize": True}),
+}
+# Bumped when the rendering changes, so previously cached thumbnails are no longer used
+THUMBNAIL_RENDER_VERSION = 1
+
+
+def get_cache_path() -> str:
+    """
+    Folder of the thumbnail cache, inside the thumbnails folder unless set explicitly
+    """
+    return os.environ.get(
+        "THUMBNAIL_CACHE_PATH", os.path.join(os.environ["THUMBNAILS_PATH"], "cache")
+    )
+
+
+def snap_width(kind: str, width: int | None) -> int:
+    """
+    Round a requested width up to the nearest supported width of a thumbnail kind
+    """
+    max_width = MAX_THUMBNAIL_WIDTHS[kind]
+    if not width:
+        return max_width
+    return min(
+        [candidate for candidate in THUMBNAIL_WIDTHS if candidate >= width] + [max_width]
+    )
+
+
+def choose_format(requested: str | None, accepts_webp: bool) -> str:
+    """
+    Pick the output format: the requested one if supported, else WebP when the client
+    accepts it and Pillow can encode it, else JPEG
+    """
+    webp_supported = features.check("webp")
+    if requested == "webp" and webp_supported:
+        return "webp"
+    if requested == "jpeg":
+        return "jpeg"
+    return "webp" if accepts_webp and webp_supported else "jpeg"
+
+
+def get_cache_key(
+    file_hash: str,
+    facial_area: tuple[int, int, int, int] | None,
+    width: int,
+    output_format: str,
+) -> str:
+    """
+    Content address of a thumbnail, so copies of a photo share their cached thumbnails
+    and a modified photo or re-detected face never shows a stale thumbnail
+    """
+    source = f"{THUMBNAIL_RENDER_VERSION}:{file_hash}:{facial_area}:{width}:{output_format}"
+    return hashlib.sha256(source.encode()).hexdigest()
+
+
+def render_thumbnail(
+    file_path: str,
+    facial_area: tuple[int, int, int, int] | None,
+    width: int,
+    output_format: str,
+) -> bytes:
+    """
+    Render the thumbnail of a photo, or of a face in it, fitting within width x width pixels.
+    The photo is decoded at the lowest resolution that still keeps the thumbnail sharp.
+    """
+    with Image.open(file_path) as image:
+        longest_side = max(image.size)
+
+    if facial_area is None:
+        image, _ = load_image(file_path, width)
+    else:
+        face_left, face_top, face_width, face_height = facial_area
+        # Facial areas are in original coordinates, decode so the face is still width pixels
+        max_side = -(-longest_side * width // max(face_width, face_height, 1))
+        image, scale = load_image(file_path, max_side)
+        image = image.crop(
+            (
+                round(face_left / scale),
+                round(face_top / scale),
+                round((face_left + face_width) / scale),
+                round((face_top + face_height) / scale),
+            )
+        )
+
+    image.thumbnail((width, width))
+
+    pillow_format, _, options = THUMBNAIL_FORMATS[output_format]
+    if image.mode not in ("RGB", "RGBA") or (pillow_format == "JPEG" and image.mode != "RGB"):
+        image = image.convert("RGB")
+
+    output = io.BytesIO()
+    image.save(output, pillow_format, **options)
+    return output.getvalue()
+
+
+class ThumbnailCache:
+    """
+    Content-addressed disk cache of rendered thumbnails with least recently used eviction
+    under a byte budget. Concurrent requests for the same thumbnail share a single render.
+    """
+
+    def __init__(self, path: str, max_bytes: int = THUMBNAIL_CACHE_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.size = None
+        self.lock = threading.Lock()
+        self.eviction_lock = threading.Lock()
+        # Lock and number of waiting requests per thumbnail that is being rendered
+        self.renders = {}
+
+    def get_path(self, key: str, extension: str) -> str:
+        """
+        Location of a cached thumbnail, spread over subfolders to keep folders small
+        """
+        return os.path.join(self.path, key[:2], f"{key}.{extension}")
+
+    def get(self, key: str, extension: str, render: Callable[[], bytes]) -> str:
+        """
+        Return the path of a cached thumbnail, rendering and storing it first when it's missing
+        """
+        path = self.get_path(key, extension)
+        if self.touch(path):
+            return path
+
+        with self.lock:
+            render_lock, waiting = self.renders.get(key, (threading.Lock(), 0))
+            self.renders[key] = (render_lock, waiting + 1)
+
+        try:
+            with render_lock:
+                # Another request may have rendered it while this one was waiting
+                if self.touch(path):
+                    return path
+                self.store(path, render())
+        finally:
+            with self.lock:
+                render_lock, waiting = self.renders[key]
+                if waiting == 1:
+                    del self.renders[key]
+                else:
+                    self.renders[key] = (render_lock, waiting - 1)
+
+        return path
+
+    def touch(self, path: str) -> bool:
+        """
+        Mark a cached thumbnail as recently used, returns whether it exists. The modification
+        time is used to track usage, as access times are often not updated by the filesystem.
+        """
+        try:
+            os.utime(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def store(self, path: str, data: bytes):
+        """
+        Atomically write a rendered thumbnail, so other processes never serve a partial file,
+        and evict the least recently used thumbnails when the cache outgrows its budget
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(temporary_path, path)
+
+        with self.lock:
+            if self.size is not None:
+                self.size += len(data)
+            over_budget = self.size is None or self.size > self.max_bytes
+
+        if over_budget:
+            self.evict()
+
+    def evict(self):
+        """
+        Measure the cache and remove the least recently used thumbnails until it is below
+        the low watermark of its budget, other processes sharing the cache are accounted for
+        """
+        if not self.eviction_lock.acquire(blocking=False):
+            return  # Already evicting in another thread
+
+        try:
+            entries = []
+            for folder in os.scandir(self.path):
+                if not folder.is_dir():
+                    continue
+                for entry in os.scandir(folder.path):
+                    if entry.name.endswith(".tmp"):
+                        continue  # Still being written
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue  # Evicted by another process
+                    entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+
+            size = sum(entry_size for _, entry_size, _ in entries)
+            if size > self.max_bytes:
+                target = self.max_bytes * THUMBNAIL_CACHE_LOW_WATERMARK
+                for _, entry_size, entry_path in sorted(entries):
+                    if size <= target:
+                        break
+                    try:
+                        os.remove(entry_path)
+                    except FileNotFoundError:
+                        pass
+                    size -= entry_size
+
+            with self.lock:
+                self.size = size
+        finally:
+            self.eviction_lock.release()
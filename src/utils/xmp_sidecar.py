@@ -0,0 +1,89 @@
+"""Helpers to write person tags to XMP sidecar files next to the original photos"""
+
+import os
+import tempfile
+from xml.sax.saxutils import escape
+
+# Naming of sidecars: "extension" appends .xmp to the filename (photo.jpg.xmp, as digiKam
+# does), "basename" replaces the extension (photo.xmp, as Lightroom does)
+XMP_SIDECAR_NAMING = os.environ.get("XMP_SIDECAR_NAMING", "extension")
+# Toolkit name marking the sidecars written by us, other sidecars are only updated by ExifTool
+XMP_TOOLKIT = "tag-my-photos"
+
+XMP_SIDECAR_TEMPLATE = """<?xpacket begin="\ufeff" id="W5M0MpCehiHzreSzNTczkc9d"?>
+<x:xmpmeta xmlns:x="adobe:ns:meta/" x:xmptk="{toolkit}">
+ <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
+  <rdf:Description rdf:about=""
+    xmlns:dc="http://purl.org/dc/elements/1.1/">
+   <dc:subject>
+    <rdf:Bag>
+{items}
+    </rdf:Bag>
+   </dc:subject>
+  </rdf:Description>
+ </rdf:RDF>
+</x:xmpmeta>
+<?xpacket end="w"?>
+"""
+
+
+def get_sidecar_path(file_path: str, naming: str = XMP_SIDECAR_NAMING) -> str:
+    """
+    Path of the XMP sidecar of a photo
+    """
+    if naming == "basename":
+        return os.path.splitext(file_path)[0] + ".xmp"
+    return file_path + ".xmp"
+
+
+def render_sidecar(subject: list[str]) -> bytes:
+    """
+    Render a minimal XMP sidecar holding only the Subject tag, marked as written by us
+    """
+    items = "\n".join(f"     <rdf:li>{escape(name)}</rdf:li>" for name in subject)
+    return XMP_SIDECAR_TEMPLATE.format(toolkit=XMP_TOOLKIT, items=items).encode("utf-8")
+
+
+def is_own_sidecar(data: bytes) -> bool:
+    """
+    Whether a sidecar was written by us, so it can be replaced as a whole
+    """
+    return f'x:xmptk="{XMP_TOOLKIT}"'.encode() in data
+
+
+def write_own_sidecar(sidecar_path: str, subject: list[str], file_path: str) -> bool | None:
+    """
+    Write the sidecar of a photo when it doesn't exist yet or was written by us, only when
+    its content changes, or remove it when there is no subject anymore. Returns whether it
+    was written, or None for a sidecar of another application.
+    """
+    data = render_sidecar(subject)
+    try:
+        with open(sidecar_path, "rb") as f:
+            existing = f.read()
+    except FileNotFoundError:
+        existing = None
+
+    if existing is not None:
+        if not is_own_sidecar(existing):
+            return None
+        if existing == data:
+            return False
+
+    if not subject:
+        if existing is None:
+            return False
+        os.remove(sidecar_path)
+        return True
+
+    # Write atomically, so an interrupted run never leaves a truncated sidecar
+    fd, temporary_path = tempfile.mkstemp(
+        dir=os.path.dirname(sidecar_path), prefix=".", suffix=".xmp.tmp"
+    )
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+        # mkstemp creates files readable only by us, while other applications and users
+        # reading the library should be able to read the sidecar like the photo itself
+        os.fchmod(f.fileno(), os.stat(file_path).st_mode & 0o666)
+    os.replace(temporary_path, sidecar_path)
+    return True
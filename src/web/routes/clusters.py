@@ -4,6 +4,7 @@ import os
 from flask import Blueprint, render_template
 from sqlalchemy import create_engine, select
 from src.utils.tables import clusters as clusters_table, faces as faces_table
+from src.web.routes.files import face_thumbnail_path
 
 blueprint = Blueprint('clusters', __name__, url_prefix='/clusters')
 
@@ -36,7 +37,7 @@ def index():
             data_clusters.setdefault(str(row.cluster_id), []).append({
                 "face_id": row.face_id,
                 "file_id": row.file_id,
-                "thumbnail_path": "/files/thumbnails/" + row.thumbnail_filename
+                "thumbnail_path": face_thumbnail_path(row.face_id, row.thumbnail_filename, 320)
             })
         print(data_clusters)
         conn.close()
@@ -3,7 +3,13 @@ import os
 
 from flask import Blueprint, render_template, request
 from sqlalchemy import create_engine, select
-from src.utils.tables import faces as faces_table, persons as persons_table
+from src.web.routes.files import face_thumbnail_path
+from src.utils.persons_index import refresh_persons
+from src.utils.tables import (
+    faces as faces_table,
+    label_changes as label_changes_table,
+    persons as persons_table,
+)
 
 blueprint = Blueprint("faces", __name__, url_prefix='/faces')
 
@@ -30,9 +36,7 @@ def index():
 
         data_faces = [
             {
-                "thumbnail_path": "/files/thumbnails/" + row.thumbnail_filename
-                if row.thumbnail_filename
-                else None,
+                "thumbnail_path": face_thumbnail_path(row.id, row.thumbnail_filename, 320),
                 "id": row.id,
                 "person_id": row.person_id,
                 "person_id_suggested": row.person_id_suggested,
@@ -68,6 +72,10 @@ def update_face(face_id):
     ):
         db_engine = create_engine("sqlite:///" + os.environ["DATABASE_PATH"])
         with db_engine.connect() as conn:
+            previous_person_id = conn.execute(
+                select(faces_table.c.person_id).where(faces_table.c.id == face_id)
+            ).scalar()
+
             # Update the face record with the new person_id
             update = (
                 faces_table.update()
@@ -75,10 +83,15 @@ def update_face(face_id):
                 .values(person_id=data["person_id"])
             )
             result = conn.execute(update)
+
+            # Let recognition re-evaluate the faces that have this face as a neighbor
+            if result.rowcount > 0 and previous_person_id != data["person_id"]:
+                conn.execute(label_changes_table.insert().values(face_id=face_id))
             conn.commit()
-            conn.close()
 
             if result.rowcount > 0:
+                # Both the person losing and the person gaining the face get new prototypes
+                refresh_persons(conn, [previous_person_id, data["person_id"]])
                 return "Face record updated successfully", 200
 
             return "Failed to update face record", 500
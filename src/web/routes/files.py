@@ -1,12 +1,52 @@
 """Defines all routes related to files"""
+import functools
 import os
 
-from flask import Blueprint, render_template, send_from_directory
+from flask import Blueprint, render_template, request, send_file, send_from_directory
 from sqlalchemy import create_engine, select, outerjoin
 from src.utils.tables import files as files_table, faces as faces_table
+from src.utils.thumbnail_cache import (
+    THUMBNAIL_FORMATS,
+    THUMBNAIL_MODE,
+    ThumbnailCache,
+    choose_format,
+    get_cache_key,
+    get_cache_path,
+    render_thumbnail,
+    snap_width,
+)
 
 blueprint = Blueprint("files", __name__, url_prefix='/files')
 
+# Seconds browsers may reuse a rendered thumbnail before revalidating it by its ETag
+THUMBNAIL_MAX_AGE = 24 * 60 * 60
+
+
+@functools.cache
+def get_thumbnail_cache():
+    """
+    Thumbnail cache shared by all requests of this process
+    """
+    return ThumbnailCache(get_cache_path())
+
+
+def face_thumbnail_path(face_id, thumbnail_filename, width):
+    """
+    URL of a face thumbnail, the pre-rendered one if it exists or else rendered on request
+    """
+    if thumbnail_filename and THUMBNAIL_MODE != "lazy":
+        return "/files/thumbnails/" + thumbnail_filename
+    return f"/files/thumbnails/face/{face_id}?w={width}"
+
+
+def file_thumbnail_path(file_id, thumbnail_filename, width):
+    """
+    URL of a file thumbnail, the pre-rendered one if it exists or else rendered on request
+    """
+    if thumbnail_filename and THUMBNAIL_MODE != "lazy":
+        return "/files/thumbnails/" + thumbnail_filename
+    return f"/files/thumbnails/file/{file_id}?w={width}"
+
 @blueprint.route("/<int:file_id>")
 def get_file(file_id):
     """
@@ -48,7 +88,9 @@ def get_file(file_id):
             "file.html",
             file_id = result_file.id,
             file_path = result_file.path,
-            thumbnail_path = "/files/thumbnails/" + result_file.thumbnail_filename,
+            thumbnail_path = file_thumbnail_path(
+                result_file.id, result_file.thumbnail_filename, 1000
+            ),
             last_updated = result_file.last_updated,
             faces = data_faces
         )
@@ -64,3 +106,81 @@ def thumbnail(filename):
     )
 
 
+def send_rendered_thumbnail(kind, file_path, file_hash, facial_area=None):
+    """
+    Serve a thumbnail at the requested width (?w=) and format (?format=webp or jpeg),
+    rendering it into the thumbnail cache on the first request
+    """
+    width = snap_width(kind, request.args.get("w", type=int))
+    output_format = choose_format(
+        request.args.get("format"), "image/webp" in request.headers.get("Accept", "")
+    )
+    key = get_cache_key(file_hash, facial_area, width, output_format)
+
+    try:
+        path = get_thumbnail_cache().get(
+            key,
+            output_format,
+            lambda: render_thumbnail(file_path, facial_area, width, output_format),
+        )
+    except OSError:
+        return "Photo not found or unreadable", 404
+
+    response = send_file(
+        path,
+        mimetype=THUMBNAIL_FORMATS[output_format][1],
+        etag=key,
+        max_age=THUMBNAIL_MAX_AGE,
+    )
+    # The format depends on the Accept header when it isn't requested explicitly
+    response.vary.add("Accept")
+    return response
+
+
+@blueprint.route("/thumbnails/face/<int:face_id>")
+def face_thumbnail(face_id):
+    """
+    Serve the thumbnail of a face, rendered on demand
+    """
+    db_engine = create_engine("sqlite:///" + os.environ["DATABASE_PATH"])
+    with db_engine.connect() as conn:
+        query_face = select(
+            files_table.c.path,
+            files_table.c.hash,
+            faces_table.c.facial_area_left,
+            faces_table.c.facial_area_top,
+            faces_table.c.facial_area_width,
+            faces_table.c.facial_area_height
+        ).join(
+            files_table, faces_table.c.file_id == files_table.c.id
+        ).where(faces_table.c.id == face_id)
+        result_face = conn.execute(query_face).fetchone()
+
+    if result_face is None:
+        return "Face not found", 404
+
+    facial_area = (
+        result_face.facial_area_left,
+        result_face.facial_area_top,
+        result_face.facial_area_width,
+        result_face.facial_area_height,
+    )
+    return send_rendered_thumbnail("face", result_face.path, result_face.hash, facial_area)
+
+
+@blueprint.route("/thumbnails/file/<int:file_id>")
+def file_thumbnail(file_id):
+    """
+    Serve the thumbnail of a file, rendered on demand
+    """
+    db_engine = create_engine("sqlite:///" + os.environ["DATABASE_PATH"])
+    with db_engine.connect() as conn:
+        query_file = select(files_table.c.path, files_table.c.hash).where(
+            files_table.c.id == file_id
+        )
+        result_file = conn.execute(query_file).fetchone()
+
+    if result_file is None:
+        return "File not found", 404
+
+    return send_rendered_thumbnail("file", result_file.path, result_file.hash)
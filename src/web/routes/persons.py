@@ -4,6 +4,7 @@ import os
 from flask import Blueprint, render_template, request
 from sqlalchemy import create_engine, select, outerjoin
 from src.utils.tables import faces as faces_table, persons as persons_table
+from src.web.routes.files import face_thumbnail_path
 
 blueprint = Blueprint('persons', __name__, url_prefix='/persons')
 
@@ -17,6 +18,7 @@ def index():
         # Select 1 face per person
         first_faces = select(
             faces_table.c.person_id,
+            faces_table.c.id.label("face_id"),
             faces_table.c.thumbnail_filename
         ).where(faces_table.c.person_id.isnot(None)
         ).group_by(faces_table.c.person_id
@@ -27,6 +29,7 @@ def index():
         query_persons = select(
             persons_table.c.id,
             persons_table.c.name,
+            first_faces.c.face_id,
             first_faces.c.thumbnail_filename
         ).select_from(
             outerjoin(persons_table, first_faces, persons_table.c.id == first_faces.c.person_id)
@@ -36,7 +39,10 @@ def index():
         data_persons = [{
             "id": row.id,
             "name": row.name,
-            "thumbnail_path": "/files/thumbnails/" + row.thumbnail_filename
+            # Persons without faces have no thumbnail
+            "thumbnail_path": face_thumbnail_path(row.face_id, row.thumbnail_filename, 320)
+            if row.face_id is not None
+            else None
         } for row in result_persons]
         conn.close()
 
@@ -69,7 +75,7 @@ def get_person(person_id):
         data_faces = [{
             "id": row.id,
             "file_id": row.file_id,
-            "thumbnail_path": "/files/thumbnails/" + row.thumbnail_filename,
+            "thumbnail_path": face_thumbnail_path(row.id, row.thumbnail_filename, 320),
             "facial_area_top": row.facial_area_top,
             "facial_area_left": row.facial_area_left,
             "facial_area_width": row.facial_area_width,